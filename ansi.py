@@ -1,40 +1,96 @@
 # -*- coding: utf-8 -*-
 
-from collections import namedtuple
+from . import ansi_engine
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
-import bisect
+from itertools import groupby
 import Default
-import inspect
+import hashlib
 import json
 import os
 import re
 import sublime
 import sublime_plugin
+import sys
+import threading
+import time
 
 DEBUG = False
 
-AnsiDefinition = namedtuple("AnsiDefinition", "scope regex")
-regex_obj_cache = {}
+# views larger than ANSI_lazy_size are split in segments of this size, which are
+# colorized in the background as many as fit into an ANSI_time_slice at a time
+ANSI_LAZY_SEGMENT_SIZE = 128 * 1024
+# the number of characters before the end of the colorized text of a view whose digest tells
+# whether text has only been appended since
+ANSI_TAIL_DIGEST_SIZE = 256
+# a burst of settings changes regenerates the color scheme once, this many ms after the last
+ANSI_COLOR_SCHEME_DELAY = 500
+
+# the ansi region store of each view: view id: AnsiRegionStore
+ansi_region_stores = {}
+# the lazy colorization in progress of each view: view id: AnsiLazyJob
+ansi_lazy_jobs = {}
+# the SGR state at the end of the colorized text of each view: view id: AnsiState
+ansi_end_states = {}
+# the views with a pending check for text left to colorize: view ids
+ansi_left_checks = set()
+# the views checked while being colorized, checked again once it is done: view ids
+ansi_left_waiting = set()
+# the regions of build output handed over to the ansi command: view id: [AnsiRegion]
+ansi_build_regions = {}
+# the output views of the running builds, colorized by AnsiColorBuildCommand: view ids
+ansi_build_views = set()
+# the sidecars checked when their view opened, for the ansi command: view id: (regions, state)
+ansi_sidecars = {}
+# the raw text colorized in the views of files, see ANSI_tail_mode: view id: AnsiRawText
+ansi_raw_texts = {}
+# the process pool of the parallel colorization, see ANSI_pool_size
+ansi_pool = None
+ansi_pool_size = 0
+# set once the pool failed, e.g. processes cannot be spawned from the plugin host
+ansi_pool_broken = False
+# the compiled ANSI_FG and ANSI_BG settings, dropped when they change
+ansi_table = None
+# the scopes allocated on demand whose rules are in the color scheme
+ansi_scheme_scopes = None
+# the sha1 of the color scheme file content, None until it has been read
+ansi_scheme_digest = None
+# the number of ANSI_COLORS_CHANGE notifications, only the last one regenerates
+ansi_scheme_generation = 0
+# set while a regeneration for the scopes allocated on demand is scheduled
+ansi_scheme_pending = False
+# the timings of the colorization phases, recorded if ANSI_stats is set
+ansi_stats = ansi_engine.AnsiStats()
+
+
+def debug(view, msg, *args):
+    """
+    @brief Print a message about a view if DEBUG is set.
 
+    @param view the View object
+    @param msg  the message, formatted with args only if it is printed
+    @param args the arguments of msg
+    """
 
-def debug(view, msg):
     if not DEBUG:
         return
 
-    info = inspect.getframeinfo(inspect.stack()[1][0])
-    filepath = os.path.abspath(info.filename)
+    frame = sys._getframe(1)
+    filepath = os.path.abspath(frame.f_code.co_filename)
     if view.name():
         name = view.name()
     elif view.file_name():
         name = os.path.basename(view.file_name())
     else:
         name = "not named"
+    if args:
+        msg = msg.format(*args)
     msg = re.sub(r"\n", "\n\t", msg)
 
     print(
         'File: "{path}", line {lineno}, window: {window_id}, view: {view_id}, file: {name}\n\t{msg}'.format_map(
             {
-                "lineno": info.lineno,
+                "lineno": frame.f_lineno,
                 "msg": msg,
                 "name": name,
                 "path": filepath,
@@ -62,124 +118,771 @@ def camel_to_snake(camel: str) -> str:
     return "_".join(re.findall(r"[A-Z][^A-Z]*", camel)).lower()
 
 
-def get_regex_obj(regex_string):
+def is_ansi_syntax(view):
+    syntax = view.settings().get("syntax")
+
+    if not syntax:
+        return False
+
+    return syntax.startswith("Packages/ANSIescape/ANSI.")
+
+
+def is_ansi_clean(view, begin=0, state=None):
+    """
+    @brief Whether the text of a view after an offset has nothing to colorize: it has no
+           escape character, which every ansi code begins with, and is not colored by the
+           SGR state at the offset.
+
+    The view is searched without copying its text, so that clean views and build output
+    cost next to nothing.
+
+    @param view  the View object
+    @param begin the offset
+    @param state the SGR state at the offset
+
+    @return bool
     """
-    @brief Get the regular expression object.
 
-    @param regex_string the regular expression string
+    if state is not None and ansi_definition_table().scope(state) is not None:
+        return False
+    region = view.find("\x1b", begin, sublime.LITERAL)
+
+    return region is None or region.begin() < 0
+
+
+def ansi_definition_table():
+    """
+    @brief Get the AnsiDefinitionTable of the current ANSI_FG and ANSI_BG settings.
 
-    @return The regular expression object.
+    @return AnsiDefinitionTable
     """
 
-    if regex_string not in regex_obj_cache:
-        regex_obj_cache[regex_string] = re.compile(regex_string)
+    global ansi_table
+
+    if ansi_table is None:
+        settings = sublime.load_settings("ansi.sublime-settings")
+        ansi_table = ansi_engine.AnsiDefinitionTable(
+            settings.get("ANSI_FG", []), settings.get("ANSI_BG", [])
+        )
 
-    return regex_obj_cache[regex_string]
+    return ansi_table
 
 
-def fast_view_find_all(view, regex_string):
+def invalidate_ansi_definition_table(settings):
+    """
+    @brief Drop the AnsiDefinitionTable if the ANSI_FG or ANSI_BG settings changed.
+
+    @param settings the ansi.sublime-settings Settings object
     """
-    @brief A faster implementation of View.find_all().
 
-    @param view         the View object
-    @param regex_string the regular expression string
+    global ansi_table
 
-    @return sublime.Region[]
+    if ansi_table is not None and not ansi_table.matches(
+        settings.get("ANSI_FG", []), settings.get("ANSI_BG", [])
+    ):
+        ansi_table = None
+
+
+def ansi_definitions():
+    return ansi_definition_table().definitions()
+
+
+def ansi_region_store(view):
     """
+    @brief Get the region store of a view.
 
-    regex_obj = get_regex_obj(regex_string)
-    content = view.substr(sublime.Region(0, view.size()))
+    The keys of the stores are recorded in the view's settings, so that a store lost with
+    a plugin reload or a restart can be rebuilt and its regions erased or appended to.
 
-    iterator = regex_obj.finditer(content)
+    @param view the View object
 
-    if iterator is None:
-        return []
+    @return AnsiRegionStore
+    """
 
-    return [sublime.Region(*(m.span())) for m in iterator]
+    store = ansi_region_stores.get(view.id())
+    if store is None:
+        store = ansi_region_stores[view.id()] = ansi_engine.AnsiRegionStore()
+        store.restore(view.settings().get("ansi_regions", {}))
 
+    return store
 
-def is_ansi_syntax(view):
-    syntax = view.settings().get("syntax")
 
-    if not syntax:
-        return False
+def add_ansi_regions(view, scope, regions):
+    """
+    @brief Append regions of a scope to the ones already added to the view.
 
-    return syntax.startswith("Packages/ANSIescape/ANSI.")
+    @param view    the View object
+    @param scope   the scope of the regions
+    @param regions the (a, b) regions
+    """
 
+    store = ansi_region_store(view)
+    count = len(store.buckets.get(scope, ()))
+    added, erased = store.append(scope, regions)
+    if len(store.buckets[scope]) != count:
+        view.settings().set("ansi_regions", store.counts())
+    for key, key_regions in added:
+        view.add_regions(
+            key,
+            [sublime.Region(a, b) for a, b in key_regions],
+            scope,
+            "",
+            sublime.DRAW_NO_OUTLINE | sublime.PERSISTENT,
+        )
+    for key in erased:
+        view.erase_regions(key)
 
-def ansi_definitions(content=None):
 
+def trim_ansi_regions(view):
+    """
+    @brief Drop the colors of the oldest output of a long build once its output view has
+           more than ANSI_max_regions regions.
+
+    @param view the View object
+    """
+
+    limit = sublime.load_settings("ansi.sublime-settings").get("ANSI_max_regions", 0)
+    for key in ansi_region_store(view).trim(limit):
+        view.erase_regions(key)
+
+
+def erase_ansi_regions(view):
+    """
+    @brief Erase all the ansi regions of the view.
+
+    @param view the View object
+    """
+
+    if view.settings().has("ansi_size") and not view.settings().has("ansi_regions"):
+        # colorized by a version which did not record its keys, try them all
+        for ansi in ansi_definitions():
+            view.erase_regions(ansi.scope)
+    for key in ansi_region_store(view).keys():
+        view.erase_regions(key)
+    ansi_region_stores.pop(view.id(), None)
+    view.settings().erase("ansi_regions")
+
+
+def colorize_ansi_text(view, edit, begin, end, state=None):
+    """
+    @brief Strip the ansi codes of a part of the view and add its ansi regions.
+
+    @param view  the View object
+    @param edit  the Edit object
+    @param begin the begin of the part
+    @param end   the end of the part, it must not be inside an escape code
+    @param state the SGR state at the begin of the part
+
+    @return (removed, state, result) the number of characters removed from the part, the
+            SGR state at its end and its AnsiParseResult
+    """
+
+    content = view.substr(sublime.Region(begin, end))
+    result, state = parse_ansi_text(content, state)
+    removed = apply_ansi_result(view, edit, begin, content, result)
+
+    return removed, state, result
+
+
+def parse_ansi_text(content, state=None):
+    """
+    @brief ansi_parse a text, in the process pool if it is large enough.
+
+    @param content the text containing ansi escape codes
+    @param state   the SGR state at the begin of the text
+
+    @return (result, state) the AnsiParseResult and the SGR state at the end of the text
+    """
+
+    settings = sublime.load_settings("ansi.sublime-settings")
+    with ansi_stats.phase("parse") as phase:
+        result = None
+        if len(content) >= settings.get("ANSI_pool_threshold", 4194304):
+            pool = ansi_process_pool()
+            if pool is not None:
+                try:
+                    result, state = ansi_engine.ansi_parse_parallel(
+                        content, ansi_definition_table(), pool, 4 * ansi_pool_size, state
+                    )
+                except Exception as e:
+                    print("ANSIescape: parallel colorization failed, now serial: {}".format(e))
+                    shutdown_ansi_pool(broken=True)
+
+        if result is None:
+            stream = ansi_stream()
+            stream.state = state
+            result = stream.feed(content, final=True)
+            state = stream.state
+        phase.chars = len(content)
+        phase.codes = len(result.offsets)
+
+    return result, state
+
+
+def apply_ansi_result(view, edit, begin, content, result):
+    """
+    @brief Strip the ansi codes of a part of the view and add its ansi regions.
+
+    @param view    the View object
+    @param edit    the Edit object
+    @param begin   the begin of the part
+    @param content the text of the part
+    @param result  the AnsiParseResult of the text, it is not modified
+
+    @return The number of characters removed from the part.
+    """
+
+    # removing ansi escaped codes with as few edits as possible, they all belong to the
+    # running command and are therefore reverted by a single undo
     settings = sublime.load_settings("ansi.sublime-settings")
+    removed = len(content) - len(result.text)
+    with ansi_stats.phase("strip") as phase:
+        for a, b, text in ansi_engine.ansi_strip_edits(result, settings.get("ANSI_strip_span", 0)):
+            view.replace(edit, sublime.Region(begin + a, begin + b), text)
+        phase.chars = removed
+        phase.codes = len(result.offsets)
+
+    # regions added before for the text following the part moved with it
+    store = ansi_region_stores.get(view.id())
+    end = begin + len(content)
+    if store is not None and end < view.size() + removed:
+        with ansi_stats.phase("shift"):
+            store.shift(end, -removed)
+
+    if DEBUG:
+        spans, merged = ansi_engine.ansi_region_counts(result.regions.values())
+        debug(view, "{} regions merged into {} ({:.0%})", spans, merged, merged / max(spans, 1))
+
+    # render ansi regions (already corrected to the stripped text offsets)
+    with ansi_stats.phase("add_regions") as phase:
+        for scope, ansi_region in result.regions.items():
+            regions = [(a + begin, b + begin) for a, b in ansi_region]
+            debug(view, "scope: {}\nregions: {}\n----------\n", scope, regions)
+            add_ansi_regions(view, scope, regions)
+            phase.regions += len(regions)
+
+    return removed
+
+
+def is_ansi_cached(view):
+    if not view.file_name():
+        return False
+    return sublime.load_settings("ansi.sublime-settings").get("ANSI_cache_size", 0) > 0
+
+
+def ansi_cache_key(content):
+    """
+    @brief Get the key of a text in the cache of parsed files.
 
-    if content is None:
-        bgs = settings.get("ANSI_BG", [])
-        fgs = settings.get("ANSI_FG", [])
+    @param content the text
+
+    @return The digest of the text and of the ANSI_FG and ANSI_BG settings.
+    """
+
+    digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    return "{}-{}".format(digest, ansi_definition_table().revision[:16])
+
+
+def ansi_cache_dir():
+    return os.path.join(os.path.dirname(ansi_color_scheme_file()), "cache")
+
+
+def read_ansi_cache(key):
+    """
+    @brief Read an entry of the cache of parsed files.
+
+    @param key the ansi_cache_key
+
+    @return (result, state) the AnsiParseResult without its text and the SGR state at the
+            end of the file, None if there is no valid entry
+    """
+
+    path = os.path.join(ansi_cache_dir(), key)
+    try:
+        with ansi_stats.phase("cache_read") as phase:
+            with open(path, "rb") as cache_file:
+                data = cache_file.read()
+            entry = ansi_engine.ansi_cache_loads(data)
+            phase.chars = len(data)
+        # the least recently used entries are evicted first
+        os.utime(path)
+    except OSError:
+        return None
+    if entry is None:
+        return None
+
+    result, state, rules = entry
+    for scope, rule in rules.items():
+        ansi_definition_table().rules.setdefault(scope, rule)
+
+    return result, state
+
+
+def write_ansi_cache(key, result, state):
+    """
+    @brief Write an entry of the cache of parsed files and evict the least recently used
+           entries which exceed the ANSI_cache_size setting.
+
+    @param key    the ansi_cache_key
+    @param result the AnsiParseResult
+    @param state  the SGR state at the end of the file
+    """
+
+    cache_dir = ansi_cache_dir()
+    try:
+        with ansi_stats.phase("cache_write") as phase:
+            data = ansi_engine.ansi_cache_dumps(result, state, ansi_definition_table().rules)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_file = os.path.join(cache_dir, key + ".tmp")
+            with open(tmp_file, "wb") as cache_file:
+                cache_file.write(data)
+            os.replace(tmp_file, os.path.join(cache_dir, key))
+            phase.chars = len(data)
+
+        limit = sublime.load_settings("ansi.sublime-settings").get("ANSI_cache_size", 0)
+        entries = []
+        for name in os.listdir(cache_dir):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= limit * 1024 * 1024:
+                break
+            os.remove(os.path.join(cache_dir, name))
+            total -= size
+    except OSError as e:
+        print("ANSIescape: cannot write the cache: {}".format(e))
+
+
+def ansi_sidecar_file(view):
+    """
+    @brief Get the sidecar of the regions of a view's file, see ansi_engine.ansi_convert.
+
+    @param view the View object
+
+    @return The path of the sidecar or None if the file has none.
+    """
+
+    if not view.file_name():
+        return None
+    path = view.file_name() + ansi_engine.ANSI_SIDECAR_SUFFIX
+
+    return path if os.path.isfile(path) else None
+
+
+def read_ansi_sidecar(view):
+    """
+    @brief Read the sidecar of the regions of a view's file.
+
+    @param view the View object
+
+    @return (regions, state) the {scope: AnsiRegion} regions and the SGR state at the end
+            of the file, None if there is no sidecar or it does not match the view's text
+    """
+
+    path = ansi_sidecar_file(view)
+    if path is None:
+        return None
+    with ansi_stats.phase("sidecar_read") as phase:
+        try:
+            with open(path, "rb") as sidecar:
+                entry = ansi_engine.ansi_sidecar_loads(sidecar.read())
+        except OSError:
+            return None
+        if entry is None:
+            print("ANSIescape: invalid sidecar {}".format(path))
+            return None
+        size, digest, state, state_regions = entry
+        content = view.substr(sublime.Region(0, view.size()))
+        if size != len(content) or digest != hashlib.sha1(content.encode("utf-8")).hexdigest():
+            debug(view, "The sidecar {} does not match the text", path)
+            return None
+        phase.chars = size
+
+        # the states are given the scopes of the current ANSI_FG and ANSI_BG settings
+        regions = {}
+        for region_state, state_region in state_regions.items():
+            scope = ansi_definition_table().scope(region_state)
+            if scope is None:
+                continue
+            if scope not in regions:
+                regions[scope] = state_region
+                state_region.scope = scope
+                continue
+            # several states with the same scope
+            region = ansi_engine.AnsiRegion(scope)
+            for a, b in sorted(list(regions[scope]) + list(state_region)):
+                region.add(a, b)
+            regions[scope] = region
+        phase.regions = sum(len(region) for region in regions.values())
+
+    return regions, state
+
+
+def ansi_process_pool():
+    """
+    @brief Get the process pool of the ANSI_pool_size setting.
+
+    @return The ProcessPoolExecutor or None if the colorization has to be serial.
+    """
+
+    global ansi_pool, ansi_pool_size
+
+    size = sublime.load_settings("ansi.sublime-settings").get("ANSI_pool_size", 0)
+    if size < 2 or ansi_pool_broken:
+        return None
+    if ansi_pool is not None and ansi_pool_size != size:
+        shutdown_ansi_pool()
+    if ansi_pool is None:
+        ansi_pool = ProcessPoolExecutor(size)
+        ansi_pool_size = size
+
+    return ansi_pool
+
+
+def shutdown_ansi_pool(broken=False):
+    global ansi_pool, ansi_pool_broken
+
+    if ansi_pool is not None:
+        ansi_pool.shutdown(wait=False)
+        ansi_pool = None
+    ansi_pool_broken = ansi_pool_broken or broken
+
+
+def cancel_ansi_job(view):
+    """
+    @brief Stop the lazy colorization of a view, the part already done is kept.
+
+    @param view the View object
+    """
+
+    if ansi_lazy_jobs.pop(view.id(), None) is None:
+        return
+    ansi_raw_texts.pop(view.id(), None)
+    view.erase_status("ansi")
+    set_ansi_colorized(view, None)
+
+
+def set_ansi_colorized(view, state, size=None):
+    """
+    @brief Record that the colorization of a view is done.
+
+    @param view  the View object
+    @param state the SGR state at the end of the colorized text
+    @param size  the end of the colorized text, defaults to the end of the view
+    """
+
+    if size is None:
+        size = view.size()
+    ansi_end_states[view.id()] = state
+    view.settings().set("ansi_in_progress", False)
+    view.settings().set("ansi_size", size)
+    view.settings().set("ansi_tail_digest", ansi_tail_digest(view, size))
+    if size == view.size():
+        view.settings().set("ansi_change_count", view.change_count())
     else:
-        # collect colors from file content and make them a string
-        color_str = "{0}{1}{0}".format(
-            "\x1b",
-            "\x1b".join(
-                set(
-                    # find all possible colors
-                    re.findall(r"\[[0-9;]*m", content)
-                )
-            ),
-        )
+        # the text after the colorized text, e.g. appended meanwhile, is left to the check
+        view.settings().erase("ansi_change_count")
+    if view.id() in ansi_left_waiting:
+        # modified while being colorized
+        ansi_left_waiting.discard(view.id())
+        AnsiEventListener().detect_left_ansi(view)
 
-        # filter out unnecessary colors in user settings
-        bgs = [
-            v
-            for v in settings.get("ANSI_BG", [])
-            if get_regex_obj(v["code"]).search(color_str) is not None
-        ]
-        fgs = [
-            v
-            for v in settings.get("ANSI_FG", [])
-            if get_regex_obj(v["code"]).search(color_str) is not None
+
+def ansi_tail_digest(view, end):
+    """
+    @brief Get the digest of the text just before an offset of the view.
+
+    @param view the View object
+    @param end  the offset
+
+    @return str
+    """
+
+    text = view.substr(sublime.Region(max(0, end - ANSI_TAIL_DIGEST_SIZE), end))
+
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def ansi_stream():
+    return ansi_engine.AnsiStream(ansi_definition_table())
+
+
+def keeps_ansi_raw_text(view):
+    # only the view of a file can be reloaded with the codes of its text
+    if not view.file_name():
+        return False
+    return sublime.load_settings("ansi.sublime-settings").get("ANSI_tail_mode", True)
+
+
+def keep_ansi_raw_text(view, content, result):
+    """
+    @brief Record the raw text colorized from the begin of a view, if it is kept.
+
+    @param view    the View object
+    @param content the raw text
+    @param result  its AnsiParseResult
+    """
+
+    if keeps_ansi_raw_text(view):
+        raw = ansi_raw_texts[view.id()] = AnsiRawText()
+        raw.extend(content, result)
+    else:
+        ansi_raw_texts.pop(view.id(), None)
+
+
+def ansi_text_end(view, begin=0):
+    """
+    @brief Get the end of the text of a view to colorize, an escape code cut at the end of
+           the view is left for the text appended next.
+
+    @param view  the View object
+    @param begin the begin of the text
+
+    @return The offset.
+    """
+
+    window_begin = max(begin, view.size() - 64)
+    window = view.substr(sublime.Region(window_begin, view.size()))
+
+    return window_begin + ansi_engine.ansi_split_point(window)
+
+
+class AnsiSegment(object):
+    __slots__ = ("begin", "end", "done", "scanned", "state", "raw_begin", "result")
+
+    def __init__(self, begin, end):
+        super(AnsiSegment, self).__init__()
+        self.begin = begin
+        self.end = end
+        self.done = False
+        self.scanned = False
+        # the SGR state at the end of the segment once done or scanned
+        self.state = None
+        # the begin of the segment before any segment has been stripped
+        self.raw_begin = begin
+        # the AnsiParseResult (without text) once done, kept for the cache only
+        self.result = None
+
+
+class AnsiRawText(object):
+    """
+    The raw text colorized in the view of a file: its size, its sha1 and its
+    AnsiParseResult without text.
+
+    A file which grew on disk is reloaded with its codes, the raw text colorized before
+    followed by the text appended to the file. The raw text is then stripped with the
+    result kept and only the appended text is parsed.
+    """
+
+    __slots__ = ("size", "digest", "result")
+
+    def __init__(self, size=0, digest=None, result=None):
+        super(AnsiRawText, self).__init__()
+        self.size = size
+        self.digest = digest if digest is not None else hashlib.sha1()
+        if result is None:
+            result = ansi_engine.AnsiParseResult("", {}, ansi_engine.AnsiOffsetIndex())
+        self.result = result
+
+    def matches(self, view):
+        """
+        @brief Check whether the view begins with the raw text.
+
+        @param view the View object
+
+        @return bool
+        """
+
+        if self.size > view.size():
+            return False
+        content = view.substr(sublime.Region(0, self.size))
+
+        return hashlib.sha1(content.encode("utf-8")).hexdigest() == self.digest.hexdigest()
+
+    def extend(self, content, result):
+        """
+        @brief Append raw text.
+
+        @param content the raw text
+        @param result  its AnsiParseResult, it is not modified
+        """
+
+        regions = self.result.regions
+        stripped = self.size - self.result.offsets.total()
+        for scope, region in result.regions.items():
+            if scope not in regions:
+                regions[scope] = ansi_engine.AnsiRegion(scope)
+            regions[scope].extend(region, stripped)
+        self.result.offsets.extend(result.offsets, self.size)
+        self.digest.update(content.encode("utf-8"))
+        self.size += len(content)
+
+
+class AnsiLazyJob(object):
+    """
+    Viewport first colorization of a large view.
+
+    The view is split into segments which are stripped and colorized one at a time: the
+    visible ones right away, the others in the background, the pending segment closest
+    to the visible region first.
+    """
+
+    def __init__(self, view, cache_key=None):
+        super(AnsiLazyJob, self).__init__()
+        self.view = view
+        self.cache_key = cache_key
+        self.segments = []
+        size = ansi_text_end(view)
+        begin = 0
+        while begin < size:
+            end = min(begin + ANSI_LAZY_SEGMENT_SIZE, size)
+            if end < size:
+                # do not cut an escape code in two
+                window_begin = max(begin, end - 64)
+                window = view.substr(sublime.Region(window_begin, end))
+                end = window_begin + ansi_engine.ansi_split_point(window)
+            self.segments.append(AnsiSegment(begin, end))
+            begin = end
+        self.pending = len(self.segments)
+        self.size = size
+        self.processed = 0
+        # the sha1 of the raw text, if it is kept once done
+        self.raw_digest = None
+        if keeps_ansi_raw_text(view):
+            content = view.substr(sublime.Region(0, size))
+            self.raw_digest = hashlib.sha1(content.encode("utf-8"))
+
+    def is_done(self):
+        return self.pending == 0
+
+    def progress(self):
+        return "ANSI: {}%".format(self.processed * 100 // max(self.size, 1))
+
+    def segments_within(self, begin, end):
+        return [
+            i
+            for i, segment in enumerate(self.segments)
+            if segment.end >= begin and segment.begin <= end
         ]
 
-    for bg in bgs:
-        for fg in fgs:
-            regex = r"(?:{0}{1}|{1}{0})[^\x1b]*".format(fg["code"], bg["code"])
-            scope = "{0}{1}".format(fg["scope"], bg["scope"])
-            yield AnsiDefinition(scope, regex)
-
-
-class AnsiRegion(object):
-    def __init__(self, scope):
-        super(AnsiRegion, self).__init__()
-        self.scope = scope
-        self.regions = []
-
-    def add(self, a, b):
-        self.regions.append([a, b])
-
-    def cut_area(self, a, b):
-        begin, end = min(a, b), max(a, b)
-        for n, (a, b) in enumerate(self.regions):
-            a = self.subtract_region(a, begin, end)
-            b = self.subtract_region(b, begin, end)
-            self.regions[n] = (a, b)
-
-    def shift(self, val):
-        for n, (a, b) in enumerate(self.regions):
-            self.regions[n] = (a + val, b + val)
-
-    def jsonable(self):
-        return {self.scope: self.regions}
-
-    @staticmethod
-    def subtract_region(p, begin, end):
-        if p < begin:
-            return p
-        elif p < end:
-            return begin
-        else:
-            return p - (end - begin)
+    def next_segment(self, begin, end):
+        """
+        @brief Get the pending segment closest to a region of the view.
+
+        @param begin the begin of the region
+        @param end   the end of the region
+
+        @return The index of the segment or None if all segments are done.
+        """
+
+        closest = None
+        closest_distance = None
+        for i, segment in enumerate(self.segments):
+            if segment.done:
+                continue
+            distance = max(segment.begin - end, begin - segment.end, 0)
+            if closest is None or distance < closest_distance:
+                closest, closest_distance = i, distance
+
+        return closest
+
+    def start_state(self, i):
+        """
+        @brief Get the SGR state at the begin of a segment.
+
+        The preceding segments are scanned backwards up to one which is done, scanned or
+        which resets the state, the states of the ones in between are then folded forward
+        and kept so that every pending segment is read at most twice.
+
+        @param i the index of the segment
+
+        @return The AnsiState or None.
+        """
+
+        state = None
+        skipped = []
+        for segment in reversed(self.segments[:i]):
+            if segment.done or segment.scanned:
+                state = segment.state
+                break
+            content = self.view.substr(sublime.Region(segment.begin, segment.end))
+            segment.state, reset = ansi_engine.ansi_end_state(content)
+            if reset:
+                segment.scanned = True
+                state = segment.state
+                break
+            skipped.append(segment)
+
+        for segment in reversed(skipped):
+            content = self.view.substr(sublime.Region(segment.begin, segment.end))
+            state = segment.state = ansi_engine.ansi_end_state(content, state)[0]
+            segment.scanned = True
+
+        return state
+
+    def process(self, edit, i):
+        """
+        @brief Strip and colorize a segment.
+
+        @param edit the Edit object
+        @param i    the index of the segment
+
+        @return The number of characters processed.
+        """
+
+        segment = self.segments[i]
+        size = segment.end - segment.begin
+        removed, segment.state, result = colorize_ansi_text(
+            self.view, edit, segment.begin, segment.end, self.start_state(i)
+        )
+        if self.cache_key is not None or self.raw_digest is not None:
+            segment.result = result._replace(text="")
+        segment.end -= removed
+        segment.done = True
+        self.pending -= 1
+        self.processed += size
+        for following in self.segments[i + 1 :]:
+            following.begin -= removed
+            following.end -= removed
+
+        return size
+
+    def result(self):
+        """
+        @brief Merge the results of the segments of a done job.
+
+        @return AnsiParseResult without text
+        """
+
+        return ansi_engine.ansi_merge_results(
+            [(segment.raw_begin, segment.begin, segment.result) for segment in self.segments]
+        )
 
 
 class AnsiCommand(sublime_plugin.TextCommand):
-    def run(self, edit, regions=None, clear_before=False):
+    def run(
+        self, edit, regions=None, clear_before=False, begin=None, build=False, reloaded=False
+    ):
+        if reloaded and self.view.id() not in ansi_raw_texts:
+            # the raw text has been dropped since the reload has been detected
+            reloaded, clear_before = False, True
+        # the characters colorized, the regions mode only adds regions
+        if regions is not None or build:
+            name, chars = "ansi_regions", 0
+        elif reloaded:
+            name, chars = "ansi_reloaded", self.view.size() - ansi_raw_texts[self.view.id()].size
+        elif begin is not None:
+            name, chars = "ansi_appended", self.view.size() - begin
+        else:
+            name, chars = "ansi", self.view.size()
+        with ansi_stats.phase(name) as phase:
+            phase.chars = chars
+            self._run(edit, regions, clear_before, begin, build, reloaded)
+
+    def _run(self, edit, regions, clear_before, begin, build, reloaded):
         view = self.view
         if view.settings().get("ansi_in_progress", False):
             debug(view, "oops ... the ansi command is already in progress")
@@ -205,81 +908,174 @@ class AnsiCommand(sublime_plugin.TextCommand):
 
         if clear_before:
             self._remove_ansi_regions()
+        if not view.settings().has("ansi_regions"):
+            view.settings().set("ansi_regions", {})
 
-        if regions is None:
-            self._colorize_ansi_codes(edit)
-        else:
+        lazy_size = sublime.load_settings("ansi.sublime-settings").get("ANSI_lazy_size", 0)
+        size = None
+        if regions is not None:
             self._colorize_regions(regions)
-
-        view.settings().set("ansi_in_progress", False)
-        view.settings().set("ansi_size", view.size())
+            state = None
+        elif build:
+            self._colorize_build_regions()
+            state = None
+        elif reloaded:
+            size, state = self._colorize_reloaded(edit)
+        elif begin is not None:
+            size, state = self._colorize_appended(edit, begin)
+        else:
+            content = cache_key = cached = None
+            sidecar = ansi_sidecars.pop(view.id(), None) or read_ansi_sidecar(view)
+            clean = sidecar is None and is_ansi_clean(view)
+            if sidecar is None and not clean and is_ansi_cached(view):
+                content = view.substr(sublime.Region(0, view.size()))
+                cache_key = ansi_cache_key(content)
+                cached = read_ansi_cache(cache_key)
+            if sidecar is not None or clean:
+                ansi_raw_texts.pop(view.id(), None)
+            if sidecar is not None:
+                state = self._colorize_sidecar(*sidecar)
+            elif clean:
+                debug(view, "No ansi codes to colorize")
+                state = None
+            elif cached is not None:
+                size, state = self._colorize_cached(edit, content, *cached)
+            elif 0 < lazy_size < view.size():
+                # ansi_in_progress is kept until the lazy colorization has been completed
+                self._colorize_lazily(edit, cache_key)
+                update_color_scheme()
+                view.set_read_only(True)
+                return
+            else:
+                size, state = self._colorize_ansi_codes(edit, content, cache_key)
+        update_color_scheme()
+
+        set_ansi_colorized(view, state, size)
         view.set_read_only(True)
 
     def _colorize_regions(self, regions):
         view = self.view
         for scope, regions_points in regions.items():
-            regions = []
-            for a, b in regions_points:
-                regions.append(sublime.Region(a, b))
-            sum_regions = view.get_regions(scope) + regions
-            view.add_regions(
-                scope, sum_regions, scope, "", sublime.DRAW_NO_OUTLINE | sublime.PERSISTENT
-            )
+            add_ansi_regions(view, scope, regions_points)
+        trim_ansi_regions(view)
 
-    def _colorize_ansi_codes(self, edit):
+    def _colorize_build_regions(self):
+        view = self.view
+        for region in ansi_build_regions.pop(view.id(), ()):
+            add_ansi_regions(view, region.scope, region)
+        trim_ansi_regions(view)
+
+    def _colorize_ansi_codes(self, edit, content=None, cache_key=None):
+        if content is None:
+            content = self.view.substr(sublime.Region(0, self.view.size()))
+        # an escape code cut at the end of the view is left for the next append
+        content = content[: ansi_engine.ansi_split_point(content)]
+        result, state = parse_ansi_text(content)
+        removed = apply_ansi_result(self.view, edit, 0, content, result)
+        if cache_key is not None:
+            write_ansi_cache(cache_key, result, state)
+        keep_ansi_raw_text(self.view, content, result)
+
+        return len(content) - removed, state
+
+    def _colorize_cached(self, edit, content, result, state):
+        debug(self.view, "Colorizing with the cached regions")
+        # the cached result is the one of the text up to the same split point
+        content = content[: ansi_engine.ansi_split_point(content)]
+        result = result._replace(text=ansi_engine.ansi_strip_text(content, result.offsets))
+        removed = apply_ansi_result(self.view, edit, 0, content, result)
+        keep_ansi_raw_text(self.view, content, result)
+
+        return len(content) - removed, state
+
+    def _colorize_sidecar(self, regions, state):
+        debug(self.view, "Colorizing with the regions of the sidecar")
+        # the file has no codes left, its regions are all in the sidecar
+        erase_ansi_regions(self.view)
+        for scope, region in regions.items():
+            add_ansi_regions(self.view, scope, list(region))
+
+        return state
+
+    def _colorize_appended(self, edit, begin):
         view = self.view
+        end = ansi_text_end(view, begin)
+        content = view.substr(sublime.Region(begin, end))
+        result, state = parse_ansi_text(content, ansi_end_states.get(view.id()))
+        removed = apply_ansi_result(view, edit, begin, content, result)
+        if view.id() in ansi_raw_texts:
+            ansi_raw_texts[view.id()].extend(content, result)
 
-        # removing unsupported ansi escape codes before going forward: 2m 4m 5m 7m 8m
-        ansi_unsupported_codes = fast_view_find_all(view, r"\x1b\[(0;)?[24578]m")
-        for r in reversed(ansi_unsupported_codes):
-            view.replace(edit, r, "\x1b[1m")
+        return end - removed, state
 
-        # collect ansi regions
-        ansi_regions = {
-            # scope: regions,
-        }
-        content = view.substr(sublime.Region(0, view.size()))
-        for ansi in ansi_definitions(content):
-            regions = fast_view_find_all(view, ansi.regex)
-            if regions:
-                debug(
-                    view,
-                    "scope: {}\nregex: {}\nregions: {}\n----------\n".format(
-                        ansi.scope, ansi.regex, ansi_regions
-                    ),
-                )
-                ansi_regions[ansi.scope] = regions
-
-        # removing ansi escaped codes
-        ansi_codes = fast_view_find_all(view, r"\x1b\[[0-9;]*m")
-        for r in reversed(ansi_codes):
-            view.erase(edit, r)
-
-        # build offset correction tables
-        correction_tables = {"points": [0], "offsets": [0]}
-        for r in ansi_codes:
-            correction_tables["points"].append(r.end())
-            correction_tables["offsets"].append(r.size() + correction_tables["offsets"][-1])
-
-        # apply offset correction to ansi regions
-        for scope, regions in ansi_regions.items():
-            for r in regions:
-                r.a -= correction_tables["offsets"][
-                    bisect.bisect(correction_tables["points"], r.a) - 1
-                ]
-                r.b -= correction_tables["offsets"][
-                    bisect.bisect(correction_tables["points"], r.b) - 1
-                ]
-            # render corrected ansi regions
-            sum_regions = view.get_regions(scope) + regions
-            view.add_regions(
-                scope, sum_regions, scope, "", sublime.DRAW_NO_OUTLINE | sublime.PERSISTENT
-            )
+    def _colorize_reloaded(self, edit):
+        view = self.view
+        debug(view, "Colorizing the reloaded raw text with its kept result")
+        raw = ansi_raw_texts[view.id()]
+        content = view.substr(sublime.Region(0, raw.size))
+        result = raw.result._replace(text=ansi_engine.ansi_strip_text(content, raw.result.offsets))
+        # the regions added before the reload do not match the text anymore
+        erase_ansi_regions(view)
+        removed = apply_ansi_result(view, edit, 0, content, result)
+
+        # the text appended to the file since
+        return self._colorize_appended(edit, raw.size - removed)
+
+    def _colorize_lazily(self, edit, cache_key=None):
+        view = self.view
+        job = ansi_lazy_jobs[view.id()] = AnsiLazyJob(view, cache_key)
+
+        # the visible region plus a margin of the same size right away
+        visible = view.visible_region()
+        margin = visible.size()
+        for i in job.segments_within(visible.begin() - margin, visible.end() + margin):
+            job.process(edit, i)
+
+        view.settings().set("ansi_undo_count", 1)
+        view.set_status("ansi", job.progress())
+        sublime.set_timeout_async(partial(view.run_command, "ansi_batch"))
 
     def _remove_ansi_regions(self):
+        erase_ansi_regions(self.view)
+
+
+class AnsiBatchCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
         view = self.view
-        for ansi in ansi_definitions():
-            view.erase_regions(ansi.scope)
+        job = ansi_lazy_jobs.get(view.id())
+        if job is None:
+            # done or cancelled
+            return
+
+        # process the segments closest to the visible region until the time slice is over
+        time_slice = sublime.load_settings("ansi.sublime-settings").get("ANSI_time_slice", 50)
+        start = time.perf_counter()
+        view.set_read_only(False)
+        visible = view.visible_region()
+        with ansi_stats.phase("ansi_batch") as phase:
+            while not job.is_done():
+                phase.chars += job.process(edit, job.next_segment(visible.begin(), visible.end()))
+                if (time.perf_counter() - start) * 1000 >= time_slice:
+                    break
+        view.settings().set("ansi_undo_count", view.settings().get("ansi_undo_count", 1) + 1)
+        update_color_scheme()
+
+        if job.is_done():
+            del ansi_lazy_jobs[view.id()]
+            result = None
+            if job.cache_key is not None:
+                result = job.result()
+                write_ansi_cache(job.cache_key, result, job.segments[-1].state)
+            if job.raw_digest is not None:
+                result = result or job.result()
+                ansi_raw_texts[view.id()] = AnsiRawText(job.size, job.raw_digest, result)
+            view.erase_status("ansi")
+            last = job.segments[-1]
+            set_ansi_colorized(view, last.state, last.end)
+        else:
+            view.set_status("ansi", job.progress())
+            sublime.set_timeout_async(partial(view.run_command, "ansi_batch"))
+        view.set_read_only(True)
 
 
 class UndoAnsiCommand(sublime_plugin.WindowCommand):
@@ -302,9 +1098,10 @@ class UndoAnsiCommand(sublime_plugin.WindowCommand):
         view.settings().erase("draw_white_space")
 
         view.set_read_only(False)
-        view.run_command("undo")
-        for ansi in ansi_definitions():
-            view.erase_regions(ansi.scope)
+        # a lazily colorized view has been modified by several commands
+        for _ in range(view.settings().get("ansi_undo_count", 1)):
+            view.run_command("undo")
+        erase_ansi_regions(view)
 
         # restore the view's original scratch and read only settings
         view.set_scratch(view.settings().get("ansi_scratch", False))
@@ -313,6 +1110,11 @@ class UndoAnsiCommand(sublime_plugin.WindowCommand):
         view.settings().erase("ansi_read_only")
         view.settings().erase("ansi_in_progress")
         view.settings().erase("ansi_size")
+        view.settings().erase("ansi_change_count")
+        view.settings().erase("ansi_tail_digest")
+        view.settings().erase("ansi_undo_count")
+        ansi_end_states.pop(view.id(), None)
+        ansi_raw_texts.pop(view.id(), None)
 
 
 class AnsiEventListener(sublime_plugin.EventListener):
@@ -325,39 +1127,128 @@ class AnsiEventListener(sublime_plugin.EventListener):
     def on_pre_close(self, view):
         self.process_view_close(view)
 
+    def on_modified_async(self, view):
+        if view.settings().has("ansi_enabled"):
+            self.detect_left_ansi(view)
+
     def process_view_open(self, view):
         self._del_event_listeners(view)
         self._add_event_listeners(view)
         if is_ansi_syntax(view):
             view.run_command("ansi")
+        elif ansi_sidecar_file(view) is not None:
+            # a log stripped by ansi_engine.py is colorized from its sidecar, other files with
+            # a stale sidecar are left as they are
+            sidecar = read_ansi_sidecar(view)
+            if sidecar is not None:
+                ansi_sidecars[view.id()] = sidecar
+                view.run_command("ansi")
 
     def process_view_close(self, view):
         self._del_event_listeners(view)
+        ansi_region_stores.pop(view.id(), None)
+        ansi_build_regions.pop(view.id(), None)
+        ansi_build_views.discard(view.id())
+        ansi_sidecars.pop(view.id(), None)
+        ansi_left_waiting.discard(view.id())
+        cancel_ansi_job(view)
+        ansi_end_states.pop(view.id(), None)
+        ansi_raw_texts.pop(view.id(), None)
         # if view.settings().get("syntax") == "Packages/ANSIescape/ANSI.sublime-syntax":
         #    view.window().run_command("undo_ansi") ** this needs to be tested **
 
     def detect_left_ansi(self, view):
+        # the modifications of a view until the check runs are handled at once
+        if view.id() in ansi_left_checks:
+            return
+        ansi_left_checks.add(view.id())
         sublime.set_timeout_async(partial(self.check_left_ansi, view), 50)
 
     def check_left_ansi(self, view):
+        ansi_left_checks.discard(view.id())
         if not self._is_view_valid(view):
             self._del_event_listeners(view)
             return
         if not is_ansi_syntax(view):
             return
+        if view.id() in ansi_build_views:
+            # the output of a running build is colorized by AnsiColorBuildCommand
+            return
         if view.settings().get("ansi_in_progress", False):
-            debug(view, "ansi in progress")
-            sublime.set_timeout_async(partial(self.check_left_ansi, view), 50)
+            # checked again once the colorization has been completed, unless it has been
+            # completed meanwhile
+            ansi_left_waiting.add(view.id())
+            if view.settings().get("ansi_in_progress", False):
+                debug(view, "ansi in progress")
+                return
+            ansi_left_waiting.discard(view.id())
+        change_count = view.change_count()
+        if view.settings().get("ansi_change_count") == change_count:
             return
-        if view.settings().get("ansi_size", view.size()) != view.size():
+        colorized = view.settings().get("ansi_size")
+        size = colorized if colorized is not None else view.size()
+        if size < view.size() and self._is_appended(view, size):
+            if is_ansi_clean(view, size, ansi_end_states.get(view.id())):
+                # e.g. build output already stripped, the clean text is only skipped
+                debug(view, "ANSI view text appended without codes")
+                args = None
+            else:
+                debug(view, "ANSI view text appended. Running ansi command on it")
+                args = {"begin": size}
+        elif self._is_reloaded(view):
+            debug(view, "ANSI view reloaded with text appended. Running ansi command on it")
+            args = {"reloaded": True}
+        elif size != view.size():
             debug(view, "ANSI view size changed. Running ansi command")
-            view.run_command("ansi", args={"clear_before": True})
-        debug(view, "ANSI cmd done and no codes left")
+            args = {"clear_before": True}
+        else:
+            debug(view, "ANSI cmd done and no codes left")
+            return
+        sublime.set_timeout(partial(self.colorize_left_ansi, view, change_count, colorized, args))
+
+    def colorize_left_ansi(self, view, change_count, colorized, args):
+        """
+        @brief Colorize the text left found by check_left_ansi, in the main thread.
+
+        @param view         the View object
+        @param change_count the change count of the view when checked
+        @param colorized    the ansi_size of the view when checked
+        @param args         the arguments of the ansi command, None to only skip the text
+        """
+
+        settings = view.settings()
+        if (
+            view.change_count() != change_count
+            or settings.get("ansi_size") != colorized
+            or settings.get("ansi_in_progress", False)
+        ):
+            # changed since the check
+            self.detect_left_ansi(view)
+        elif args is None:
+            set_ansi_colorized(view, ansi_end_states.get(view.id()))
+        else:
+            view.run_command("ansi", args=args)
+
+    def _is_appended(self, view, size):
+        # the text before the old end is unchanged, e.g. not reloaded from the file with its
+        # codes, therefore only the text after it has to be colorized
+        if not sublime.load_settings("ansi.sublime-settings").get("ANSI_tail_mode", True):
+            return False
+        return view.settings().get("ansi_tail_digest") == ansi_tail_digest(view, size)
+
+    def _is_reloaded(self, view):
+        # the file has been reloaded with its codes and still begins with the raw text
+        # colorized, e.g. a log which grew on disk
+        raw = ansi_raw_texts.get(view.id())
+        return raw is not None and raw.matches(view)
 
     def detect_syntax_change(self, view):
         if not self._is_view_valid(view):
             self._del_event_listeners(view)
             return
+        if not is_ansi_syntax(view) and view.id() in ansi_lazy_jobs:
+            debug(view, "Syntax change detected (cancelling lazy ansi command).")
+            cancel_ansi_job(view)
         if view.settings().get("ansi_in_progress", False):
             return
         if is_ansi_syntax(view):
@@ -382,29 +1273,63 @@ class AnsiEventListener(sublime_plugin.EventListener):
         view.settings().add_on_change(
             "CHECK_FOR_ANSI_SYNTAX", lambda: self.detect_syntax_change(view)
         )
-        view.settings().add_on_change("CHECK_FOR_LEFT_ANSI", lambda: self.detect_left_ansi(view))
         debug(view, "ANSIescape event listeners assigned to view.")
 
     def _del_event_listeners(self, view):
         view.settings().clear_on_change("CHECK_FOR_ANSI_SYNTAX")
-        view.settings().clear_on_change("CHECK_FOR_LEFT_ANSI")
         debug(view, "ANSIescape event listener removed from view.")
 
 
+class AnsiStatsCommand(sublime_plugin.WindowCommand):
+    def run(self, reset=False):
+        """
+        @brief Show the statistics of the colorization phases in the ansi_stats panel.
+
+        @param reset whether to drop the statistics once shown
+        """
+
+        panel = self.window.create_output_panel("ansi_stats")
+        panel.run_command("append", {"characters": ansi_stats.report() + "\n"})
+        self.window.run_command("show_panel", {"panel": "output.ansi_stats"})
+        if reset:
+            ansi_stats.reset()
+
+
 class AnsiColorBuildCommand(Default.exec.ExecCommand):
 
-    process_trigger = "on_finish"
+    process_trigger = "on_data"
+    batch_latency = 100
+    batch_size = 65536
+    ansi_proc = None
+    ansi_stream = None
+    # whether a process is running, its output view is then left to this command
+    ansi_building = False
+    ansi_build_proc = None
+    # the number of characters received but not processed yet by the on_batch trigger
+    ansi_batch_len = 0
+    # the delay of the flush scheduled, None if there is none
+    ansi_batch_scheduled = None
+    ansi_batch_time = 0.0
+
+    def __init__(self, *args, **kwargs):
+        super(AnsiColorBuildCommand, self).__init__(*args, **kwargs)
+        # the (proc, chunk) pairs received but not processed yet by the on_batch trigger,
+        # appended by the thread reading the process and processed by a timeout
+        self.ansi_batch = []
+        self.ansi_batch_lock = threading.Lock()
 
     @classmethod
     def update_build_settings(self, settings):
-        val = settings.get("ANSI_process_trigger", "on_finish")
-        if val in ["on_finish", "on_data"]:
+        val = settings.get("ANSI_process_trigger", "on_data")
+        if val in ["on_finish", "on_data", "on_batch"]:
             self.process_trigger = val
         else:
             self.process_trigger = None
             sublime.error_message(
-                "ANSIescape settings warning:\n\nThe setting ANSI_process_trigger has been set to an invalid value; must be one of 'on_finish' or 'on_data'."
+                "ANSIescape settings warning:\n\nThe setting ANSI_process_trigger has been set to an invalid value; must be one of 'on_finish', 'on_data' or 'on_batch'."
             )
+        self.batch_latency = settings.get("ANSI_batch_latency", 100)
+        self.batch_size = settings.get("ANSI_batch_size", 65536)
 
     @classmethod
     def clear_build_settings(self, settings):
@@ -416,60 +1341,146 @@ class AnsiColorBuildCommand(Default.exec.ExecCommand):
             super(AnsiColorBuildCommand, self).on_data(proc, data)
             return
 
-        # replace unsupported ansi escape codes before going forward: 2m 4m 5m 7m 8m
-        unsupported_pattern = r"\x1b\[(0;)?[24578]m"
-        str_data = re.sub(unsupported_pattern, "\x1b[1m", data)
-
-        # find all regions
-        ansi_regions = []
-        for ansi in ansi_definitions(str_data):
-            if re.search(ansi.regex, str_data):
-                reg = re.finditer(ansi.regex, str_data)
-                new_region = AnsiRegion(ansi.scope)
-                for m in reg:
-                    new_region.add(*m.span())
-                ansi_regions.append(new_region)
-
-        # remove codes
-        remove_pattern = r"(\x1b\[[0-9;]*m)+"
-        ansi_codes = re.finditer(remove_pattern, str_data)
-        ansi_codes = list(ansi_codes)
-        ansi_codes.reverse()
-        for c in ansi_codes:
-            to_remove = c.span()
-            for r in ansi_regions:
-                r.cut_area(*to_remove)
-        out_data = re.sub(remove_pattern, "", str_data)
-
-        # create json serialable region representation
-        json_ansi_regions = {}
+        # the sgr state and incomplete codes are carried over between the chunks of a process
+        if self.ansi_stream is None or self.ansi_proc is not proc:
+            self.ansi_proc = proc
+            self.ansi_stream = ansi_stream()
+
+        # most chunks have no codes and no color to carry over, they are shown as they are
+        stream = self.ansi_stream
+        if "\x1b" not in data and not stream.pending:
+            if stream.state is None or stream.table.scope(stream.state) is None:
+                super(AnsiColorBuildCommand, self).on_data(proc, data)
+                return
+
+        with ansi_stats.phase("on_data") as phase:
+            result = self.ansi_stream.feed(data)
+            phase.chars = len(data)
+            phase.codes = len(result.offsets)
+            phase.regions = self._output_ansi_result(proc, result)
+
+    def _output_ansi_result(self, proc, result):
+        view = self.output_view
+
+        count = 0
         shift_val = view.size()
-        for region in ansi_regions:
+        for region in result.regions.values():
             region.shift(shift_val)
-            json_ansi_regions.update(region.jsonable())
-            
+            count += len(region)
+
         # send on_data without ansi codes
-        super(AnsiColorBuildCommand, self).on_data(proc, out_data)
+        if result.text:
+            super(AnsiColorBuildCommand, self).on_data(proc, result.text)
+
+        # send ansi command, the regions are handed over as they are instead of being
+        # serialized to its arguments
+        if count:
+            ansi_build_regions.setdefault(view.id(), []).extend(result.regions.values())
+            view.run_command("ansi", args={"build": True})
 
-        # send ansi command
-        view.run_command("ansi", args={"regions": json_ansi_regions})
+        return count
+
+    def on_data_batch(self, proc, data):
+        """
+        @brief Buffer a chunk of the output, the buffer is processed at once when it holds
+               batch_size characters or batch_latency ms after its first chunk.
+
+        The first chunk after a pause of batch_latency ms is processed right away, so that
+        sparse output is shown as soon as it is received and only bursts are buffered.
+
+        The buffer is always processed by a timeout, in the order of the chunks, and never
+        by the thread reading the process, which must not wait for the main thread.
+
+        @param proc the AsyncProcess
+        @param data the chunk
+        """
+
+        with self.ansi_batch_lock:
+            idle = not self.ansi_batch and (
+                time.perf_counter() - self.ansi_batch_time >= self.batch_latency / 1000
+            )
+            self.ansi_batch.append((proc, data))
+            self.ansi_batch_len += len(data)
+            if idle or self.ansi_batch_len >= self.batch_size:
+                delay = 0
+            else:
+                delay = self.batch_latency
+            if self.ansi_batch_scheduled is not None and self.ansi_batch_scheduled <= delay:
+                return
+            self.ansi_batch_scheduled = delay
+        sublime.set_timeout(self.flush_ansi_batch, delay)
+
+    def flush_ansi_batch(self):
+        with self.ansi_batch_lock:
+            batch, self.ansi_batch = self.ansi_batch, []
+            self.ansi_batch_len = 0
+            self.ansi_batch_scheduled = None
+            self.ansi_batch_time = time.perf_counter()
+
+        for proc, chunks in groupby(batch, key=lambda chunk: chunk[0]):
+            self.on_data_process(proc, "".join(data for _, data in chunks))
+
+    def start_ansi_build(self, proc):
+        """
+        @brief Reset the output view for the output of a new process.
+
+        @param proc the AsyncProcess
+        """
+
+        view = self.output_view
+        self.ansi_building = True
+        self.ansi_build_proc = proc
+        ansi_build_views.add(view.id())
+        # the output panel is reused, the regions and state kept of the last build are obsolete
+        ansi_build_regions.pop(view.id(), None)
+        erase_ansi_regions(view)
+        ansi_end_states.pop(view.id(), None)
+        view.settings().erase("ansi_size")
+        view.settings().erase("ansi_change_count")
+        view.settings().erase("ansi_tail_digest")
 
     def on_data(self, proc, data):
+        if not self.ansi_building or self.ansi_build_proc is not proc:
+            self.start_ansi_build(proc)
         if self.process_trigger == "on_data":
             self.on_data_process(proc, data)
+        elif self.process_trigger == "on_batch":
+            self.on_data_batch(proc, data)
         else:
             super(AnsiColorBuildCommand, self).on_data(proc, data)
 
     def on_finished(self, proc):
-        super(AnsiColorBuildCommand, self).on_finished(proc)
-        if self.process_trigger == "on_finish":
-            view = self.output_view
-            if is_ansi_syntax(view):
-                view.run_command("ansi", args={"clear_before": True})
+        if self.process_trigger == "on_batch" or self.ansi_batch:
+            # after the chunks still buffered, in the timeouts which process them
+            sublime.set_timeout(partial(self.finish_ansi_batch, proc), 0)
+        else:
+            self.finish_ansi_build(proc)
+
+    def finish_ansi_batch(self, proc):
+        self.flush_ansi_batch()
+        self.finish_ansi_build(proc)
+
+    def finish_ansi_build(self, proc):
+        with ansi_stats.phase("on_finished") as phase:
+            if self.ansi_stream is not None and self.ansi_proc is proc:
+                # an incomplete escape code left at the end of the output is shown as is
+                result = self.ansi_stream.flush()
+                phase.chars = len(result.text)
+                phase.regions = self._output_ansi_result(proc, result)
+                self.ansi_proc = self.ansi_stream = None
+            super(AnsiColorBuildCommand, self).on_finished(proc)
+            if self.ansi_build_proc is proc:
+                self.ansi_building = False
+                ansi_build_views.discard(self.output_view.id())
+            if self.process_trigger == "on_finish":
+                view = self.output_view
+                if is_ansi_syntax(view):
+                    phase.chars = view.size()
+                    view.run_command("ansi", args={"clear_before": True})
 
 
 def generate_color_scheme(cs_file, settings):
-    print("Regenerating ANSI color scheme...")
+    global ansi_scheme_scopes
 
     theme = {
         "name": "Ansi",
@@ -493,27 +1504,177 @@ def generate_color_scheme(cs_file, settings):
 
             theme["rules"].append(rule)
 
-    with open(cs_file, "w") as color_scheme:
-        color_scheme.write(json.dumps(theme, sort_keys=True, indent=4))
+    # the rules allocated on demand are named after what they render, they stay valid, but
+    # only the ones of the scopes still colored in a view are kept
+    with ansi_stats.phase("color_scheme") as phase:
+        used = ansi_used_scopes()
+        rules = {rule["scope"]: rule for rule in read_color_scheme_rules(cs_file)}
+        rules.update(ansi_definition_table().rules)
+        scopes = sorted(scope for scope in rules if scope in used)
+        theme["rules"].extend(rules[scope] for scope in scopes)
+        phase.regions = len(scopes)
+
+        if write_color_scheme(cs_file, theme):
+            print("Regenerated ANSI color scheme.")
+    ansi_scheme_scopes = set(scopes)
+    sublime.set_timeout(partial(prune_color_scheme_rules, set(rules) - used))
+
+
+def write_color_scheme(cs_file, theme):
+    """
+    @brief Write the color scheme unless the file already has the same content.
+
+    The content is written to a temporary file which then replaces the color scheme, so
+    the views reloading it never read a partly written file.
+
+    @param cs_file the color scheme file
+    @param theme   the color scheme
+
+    @return Whether the file has been written.
+    """
+
+    global ansi_scheme_digest
+
+    content = json.dumps(theme, sort_keys=True, indent=4).encode("utf-8")
+    digest = hashlib.sha1(content).hexdigest()
+    if ansi_scheme_digest is None and os.path.isfile(cs_file):
+        with open(cs_file, "rb") as color_scheme:
+            ansi_scheme_digest = hashlib.sha1(color_scheme.read()).hexdigest()
+    if digest == ansi_scheme_digest:
+        return False
+
+    tmp_file = cs_file + ".tmp"
+    with open(tmp_file, "wb") as color_scheme:
+        color_scheme.write(content)
+    os.replace(tmp_file, cs_file)
+    ansi_scheme_digest = digest
+
+    return True
+
+
+def read_color_scheme_rules(cs_file):
+    """
+    @brief Read the rules of the scopes allocated on demand from the color scheme.
+
+    @param cs_file the color scheme file
+
+    @return The rules, empty if the color scheme does not exist (yet).
+    """
+
+    try:
+        with open(cs_file) as color_scheme:
+            rules = json.load(color_scheme).get("rules", [])
+    except (OSError, ValueError):
+        return []
+
+    return [rule for rule in rules if rule.get("scope", "").startswith("ansi.")]
+
+
+def update_color_scheme():
+    """
+    @brief Regenerate the color scheme if scopes have been allocated since it has been
+           generated.
+
+    A burst of new scopes, e.g. the chunks of a build with rgb colors, is written once by
+    the regeneration ANSI_COLOR_SCHEME_DELAY ms after the first of them.
+    """
+
+    global ansi_scheme_pending, ansi_scheme_scopes
+
+    cs_file = ansi_color_scheme_file()
+    if ansi_scheme_scopes is None:
+        ansi_scheme_scopes = {rule["scope"] for rule in read_color_scheme_rules(cs_file)}
+    if ansi_scheme_pending or ansi_definition_table().rules.keys() <= ansi_scheme_scopes:
+        return
+
+    ansi_scheme_pending = True
+    settings = sublime.load_settings("ansi.sublime-settings")
+    sublime.set_timeout_async(
+        partial(regenerate_color_scheme, cs_file, settings, ansi_scheme_generation),
+        ANSI_COLOR_SCHEME_DELAY,
+    )
+
+
+def ansi_used_scopes():
+    """
+    @brief Get the scopes of the ansi regions of all the views, output panels included.
+
+    @return set
+    """
+
+    scopes = set()
+    for store in list(ansi_region_stores.values()):
+        scopes.update(store.buckets)
+    for window in sublime.windows():
+        views = window.views()
+        for panel in window.panels():
+            if panel.startswith("output."):
+                views.append(window.find_output_panel(panel[len("output.") :]))
+        for view in views:
+            if view is not None:
+                scopes.update(view.settings().get("ansi_regions", {}))
+
+    return scopes
+
+
+def prune_color_scheme_rules(scopes):
+    """
+    @brief Forget the rules of the scopes allocated on demand which have been left out of
+           the color scheme, unless a view has been colored with them since.
+
+    @param scopes the scopes left out
+    """
+
+    ansi_definition_table().prune_rules(scopes - ansi_used_scopes())
+
+
+def ansi_color_scheme_file():
+    return os.path.join(sublime.packages_path(), "User", "ANSIescape", "ansi.sublime-color-scheme")
+
+
+def ansi_colors_changed(cs_file, settings):
+    global ansi_scheme_generation
+
+    invalidate_ansi_definition_table(settings)
+    ansi_scheme_generation += 1
+    sublime.set_timeout_async(
+        partial(regenerate_color_scheme, cs_file, settings, ansi_scheme_generation),
+        ANSI_COLOR_SCHEME_DELAY,
+    )
+
+
+def regenerate_color_scheme(cs_file, settings, generation):
+    global ansi_scheme_pending
+
+    # a later change has been made meanwhile, it regenerates the color scheme itself
+    if generation == ansi_scheme_generation:
+        ansi_scheme_pending = False
+        generate_color_scheme(cs_file, settings)
+
+
+def update_ansi_stats(settings):
+    ansi_stats.enabled = settings.get("ANSI_stats", False)
 
 
 def _plugin_loaded():
     # load pluggin settings
     settings = sublime.load_settings("ansi.sublime-settings")
     # create ansi color scheme directory
-    ansi_cs_dir = os.path.join(sublime.packages_path(), "User", "ANSIescape")
+    cs_file = ansi_color_scheme_file()
+    ansi_cs_dir = os.path.dirname(cs_file)
     if not os.path.exists(ansi_cs_dir):
         os.makedirs(ansi_cs_dir)
     # create ansi color scheme file
-    cs_file = os.path.join(ansi_cs_dir, "ansi.sublime-color-scheme")
     if not os.path.isfile(cs_file):
         generate_color_scheme(cs_file, settings)
     # update the settings for the plugin
     AnsiColorBuildCommand.update_build_settings(settings)
-    settings.add_on_change("ANSI_COLORS_CHANGE", lambda: generate_color_scheme(cs_file, settings))
+    update_ansi_stats(settings)
+    settings.add_on_change("ANSI_COLORS_CHANGE", lambda: ansi_colors_changed(cs_file, settings))
     settings.add_on_change(
         "ANSI_TRIGGER_CHANGE", lambda: AnsiColorBuildCommand.update_build_settings(settings)
     )
+    settings.add_on_change("ANSI_STATS_CHANGE", lambda: update_ansi_stats(settings))
     # update the setting for each view
     for window in sublime.windows():
         for view in window.views():
@@ -525,11 +1686,13 @@ def plugin_loaded():
 
 
 def plugin_unloaded():
+    shutdown_ansi_pool()
     # update the settings for the plugin
     settings = sublime.load_settings("ansi.sublime-settings")
     AnsiColorBuildCommand.clear_build_settings(settings)
     settings.clear_on_change("ANSI_COLORS_CHANGE")
     settings.clear_on_change("ANSI_TRIGGER_CHANGE")
+    settings.clear_on_change("ANSI_STATS_CHANGE")
     # update the setting for each view
     for window in sublime.windows():
         for view in window.views():
@@ -0,0 +1,1370 @@
+# -*- coding: utf-8 -*-
+
+"""
+The ansi escape code processing of ANSIescape.
+
+This module must not depend on the sublime API, so that the text to (stripped text,
+scope regions) pipeline can be profiled and tested outside of the editor.
+"""
+
+from array import array
+from collections import deque, namedtuple
+import argparse
+import hashlib
+import io
+import json
+import re
+import sys
+import time
+import zlib
+
+ANSI_CODE_REGEX = r"\x1b\[([0-9;]*)m"
+
+AnsiDefinition = namedtuple("AnsiDefinition", "scope regex")
+AnsiParseResult = namedtuple("AnsiParseResult", "text regions offsets")
+# fg and bg are either the code of a basic color (e.g. "31", "41") or an rgb "#rrggbb"
+AnsiState = namedtuple("AnsiState", "fg bg bold italic underline inverse")
+ANSI_RESET_STATE = AnsiState(None, None, False, False, False, False)
+# the attributes turned on and off by the SGR codes
+ANSI_ATTRIBUTE_CODES = {
+    1: ("bold", True),
+    3: ("italic", True),
+    4: ("underline", True),
+    7: ("inverse", True),
+    21: ("underline", True),
+    22: ("bold", False),
+    23: ("italic", False),
+    24: ("underline", False),
+    27: ("inverse", False),
+}
+ANSI_REGION_BUCKET_SIZE = 256
+# the number of appends to the last bucket of a scope added under keys of their own before
+# they are merged into the bucket's key
+ANSI_REGION_SLOTS = 16
+ANSI_CACHE_SIZE = 1024
+# the version of the ansi_cache_dumps format, older cache entries are ignored
+ANSI_CACHE_VERSION = 1
+# the sidecar of the regions of a log stripped by ansi_convert is the log path plus this
+ANSI_SIDECAR_SUFFIX = ".ansi-regions"
+ANSI_SIDECAR_VERSION = 1
+# the number of characters ansi_convert reads at a time
+ANSI_CONVERT_CHUNK_SIZE = 1024 * 1024
+# the number of the last samples of each phase the AnsiStats report is computed from
+ANSI_STATS_WINDOW = 100
+regex_obj_cache = {}
+
+
+def get_regex_obj(regex_string):
+    """
+    @brief Get the regular expression object.
+
+    @param regex_string the regular expression string
+
+    @return The regular expression object.
+    """
+
+    if regex_string not in regex_obj_cache:
+        if len(regex_obj_cache) >= ANSI_CACHE_SIZE:
+            regex_obj_cache.clear()
+        regex_obj_cache[regex_string] = re.compile(regex_string)
+
+    return regex_obj_cache[regex_string]
+
+
+def ansi_definitions(fgs, bgs):
+    """
+    @brief Generate the definition of every ANSI_FG and ANSI_BG combination.
+
+    @param fgs the ANSI_FG settings entries
+    @param bgs the ANSI_BG settings entries
+
+    @return AnsiDefinition generator
+    """
+
+    for bg in bgs:
+        for fg in fgs:
+            regex = r"(?:{0}{1}|{1}{0})[^\x1b]*".format(fg["code"], bg["code"])
+            scope = "{0}{1}".format(fg["scope"], bg["scope"])
+            yield AnsiDefinition(scope, regex)
+
+
+def ansi_is_rgb(color):
+    return color is not None and color.startswith("#")
+
+
+def ansi_palette_color(n, base):
+    """
+    @brief Get the color of an entry of the 256 colors palette (ESC[38;5;nm).
+
+    @param n    the palette index
+    @param base the code of the first basic color (30 for fg, 40 for bg)
+
+    @return The code of the basic color for the first 16 entries, an rgb "#rrggbb" for the
+            6x6x6 color cube and the gray ramp.
+    """
+
+    if n < 8:
+        return str(base + n)
+    if n < 16:
+        return str(base + 60 + n - 8)
+    if n < 232:
+        n -= 16
+        levels = [0 if v == 0 else 55 + 40 * v for v in (n // 36, n // 6 % 6, n % 6)]
+    else:
+        levels = [8 + 10 * (n - 232)] * 3
+
+    return "#{:02x}{:02x}{:02x}".format(*levels)
+
+
+def ansi_extended_color(codes, i, base):
+    """
+    @brief Parse the arguments of an extended color code (38 or 48).
+
+    @param codes the codes of the escape code
+    @param i     the index of the extended color code
+    @param base  the code of the first basic color (30 for fg, 40 for bg)
+
+    @return (color, i) the color or None if the arguments are invalid, and the index of the
+            last argument
+    """
+
+    try:
+        if codes[i + 1] == "5":
+            n = int(codes[i + 2] or 0)
+            return (ansi_palette_color(n, base) if n < 256 else None), i + 2
+        if codes[i + 1] == "2":
+            rgb = [int(c or 0) for c in codes[i + 2 : i + 5]]
+            if len(rgb) == 3 and max(rgb) < 256:
+                return "#{:02x}{:02x}{:02x}".format(*rgb), i + 4
+            return None, i + 4
+    except (IndexError, ValueError):
+        pass
+
+    return None, len(codes)
+
+
+def ansi_next_state(state, params):
+    """
+    @brief Apply the parameters of one SGR escape code (ESC[...m) to a state.
+
+    @param state  the current AnsiState (None when no code has been seen yet)
+    @param params the parameter string of the code, e.g. "1;31"
+
+    @return The new AnsiState or None if the text following the code is unstyled.
+    """
+
+    state = state if state is not None else ANSI_RESET_STATE
+    codes = params.split(";")
+    i = 0
+    while i < len(codes):
+        code = int(codes[i] or 0)
+        if code == 0:
+            state = ANSI_RESET_STATE
+        elif code in ANSI_ATTRIBUTE_CODES:
+            # dim, blink and hidden (2, 5, 8) are not rendered
+            name, value = ANSI_ATTRIBUTE_CODES[code]
+            state = state._replace(**{name: value})
+        elif 30 <= code <= 37 or 90 <= code <= 97:
+            state = state._replace(fg=str(code))
+        elif code == 39:
+            state = state._replace(fg=None)
+        elif 40 <= code <= 47 or 100 <= code <= 107:
+            state = state._replace(bg=str(code))
+        elif code == 49:
+            state = state._replace(bg=None)
+        elif code == 38:
+            fg, i = ansi_extended_color(codes, i, 30)
+            if fg is not None:
+                state = state._replace(fg=fg)
+        elif code == 48:
+            bg, i = ansi_extended_color(codes, i, 40)
+            if bg is not None:
+                state = state._replace(bg=bg)
+        i += 1
+
+    if state == ANSI_RESET_STATE and codes[-1]:
+        # plain reset (e.g. "0") the text is left unstyled, whereas an omitted parameter
+        # (e.g. "\x1b[m") explicitly selects the default colors of the ANSI_FG settings
+        return None
+
+    return state
+
+
+def ansi_split_point(content, end=None):
+    """
+    @brief Find where the content can be split without cutting an escape code in two.
+
+    @param content the text
+    @param end     the desired split point, defaults to the end of the content
+
+    @return The split point, end or the begin of the escape code end falls into.
+    """
+
+    if end is None:
+        end = len(content)
+    esc = content.rfind("\x1b", max(0, end - 64), end)
+    if esc >= 0 and get_regex_obj(r"\x1b(\[[0-9;]*)?").fullmatch(content, esc, end):
+        return esc
+
+    return end
+
+
+def ansi_end_state(content, state=None):
+    """
+    @brief Get the SGR state at the end of the content without parsing its text.
+
+    Codes before the last reset code of the content do not matter and are skipped.
+
+    @param content the text containing ansi escape codes
+    @param state   the state at the begin of the content
+
+    @return (state, reset) the state at the end of the content and whether it does not
+            depend on the given state because the content resets it
+    """
+
+    params = [m.group(1) for m in get_regex_obj(ANSI_CODE_REGEX).finditer(content)]
+    reset = False
+    for i in range(len(params) - 1, -1, -1):
+        if int(params[i].split(";", 1)[0] or 0) == 0:
+            params = params[i:]
+            state = None
+            reset = True
+            break
+    for code in params:
+        state = ansi_next_state(state, code)
+
+    return state, reset
+
+
+def ansi_parse(content, table):
+    """
+    @brief Strip the ansi escape codes from the content and collect the ansi scope regions.
+
+    The content is walked once: every SGR escape code updates a running fg/bg/bold
+    state and the text up to the next code is assigned the scope of that state.
+
+    @param content the text containing ansi escape codes
+    @param table   the AnsiDefinitionTable of the settings
+
+    @return AnsiParseResult with the stripped text, a dict of scope: AnsiRegion (offsets
+            into the stripped text) and the AnsiOffsetIndex of the removed codes
+    """
+
+    return AnsiStream(table).feed(content, final=True)
+
+
+def ansi_line_segments(content, count):
+    """
+    @brief Split the content at line boundaries, escape codes never span lines.
+
+    @param content the text
+    @param count   the number of segments to aim for
+
+    @return The (begin, end) segments.
+    """
+
+    size = len(content)
+    step = max(1, size // max(count, 1))
+    segments = []
+    begin = 0
+    while begin < size:
+        end = content.find("\n", min(begin + step, size))
+        end = size if end < 0 else end + 1
+        segments.append((begin, end))
+        begin = end
+
+    return segments
+
+
+def ansi_parse_segment(content, state, table):
+    """
+    @brief Parse a segment of a text, to be run in a worker process.
+
+    @param content the text of the segment
+    @param state   the SGR state at the begin of the segment
+    @param table   the AnsiDefinitionTable
+
+    @return (result, rules) the AnsiParseResult of the segment and the rules of the scopes
+            the table of the worker allocated
+    """
+
+    stream = AnsiStream(table)
+    stream.state = state
+
+    return stream.feed(content, final=True), table.rules
+
+
+def ansi_parse_parallel(content, table, executor, count, state=None):
+    """
+    @brief ansi_parse the line segments of a text in parallel.
+
+    The SGR state at the begin of every segment is resolved beforehand by folding the
+    escape codes only, the results of the segments are then merged in order.
+
+    @param content  the text containing ansi escape codes
+    @param table    the AnsiDefinitionTable of the settings
+    @param executor the concurrent.futures executor to parse the segments in
+    @param count    the number of segments to aim for
+    @param state    the SGR state at the begin of the text
+
+    @return (result, state) the AnsiParseResult of the text and the SGR state at its end
+    """
+
+    segments = ansi_line_segments(content, count)
+    states = []
+    for begin, end in segments:
+        states.append(state)
+        state = ansi_end_state(content[begin:end], state)[0]
+
+    parsed = executor.map(
+        ansi_parse_segment,
+        [content[begin:end] for begin, end in segments],
+        states,
+        [table] * len(segments),
+    )
+
+    parts = []
+    stripped = 0
+    for (begin, end), (result, rules) in zip(segments, parsed):
+        table.rules.update(rules)
+        parts.append((begin, stripped, result))
+        stripped += len(result.text)
+
+    return ansi_merge_results(parts), state
+
+
+def ansi_merge_results(parts):
+    """
+    @brief Merge the AnsiParseResults of consecutive parts of a text.
+
+    @param parts the (begin, stripped_begin, result) of every part in order, the offsets of
+                 the part into the text and into the stripped text and its AnsiParseResult
+
+    @return AnsiParseResult of the text
+    """
+
+    chunks = []
+    regions = {
+        # scope: AnsiRegion,
+    }
+    offsets = AnsiOffsetIndex()
+    for begin, stripped_begin, result in parts:
+        chunks.append(result.text)
+        for scope, region in result.regions.items():
+            if scope not in regions:
+                regions[scope] = AnsiRegion(scope)
+            regions[scope].extend(region, stripped_begin)
+        offsets.extend(result.offsets, begin)
+
+    return AnsiParseResult("".join(chunks), regions, offsets)
+
+
+def ansi_strip_text(content, offsets):
+    """
+    @brief Remove the escape codes of an AnsiOffsetIndex from a text.
+
+    @param content the text containing ansi escape codes
+    @param offsets the AnsiOffsetIndex of its codes
+
+    @return The stripped text.
+    """
+
+    chunks = []
+    begin = 0
+    for a, b in offsets.spans():
+        chunks.append(content[begin:a])
+        begin = b
+    chunks.append(content[begin:])
+
+    return "".join(chunks)
+
+
+def ansi_cache_dumps(result, state, rules):
+    """
+    @brief Serialize the regions and the offset index of a parsed text.
+
+    The stripped text is not stored, ansi_strip_text gets it back from the text.
+
+    @param result the AnsiParseResult
+    @param state  the SGR state at the end of the text
+    @param rules  the color scheme rules of the scopes allocated on demand it uses
+
+    @return bytes
+    """
+
+    header = {
+        "version": ANSI_CACHE_VERSION,
+        "byteorder": sys.byteorder,
+        "state": state,
+        "rules": {scope: rules[scope] for scope in result.regions if scope in rules},
+        "offsets": len(result.offsets),
+        "regions": [[scope, len(region.regions)] for scope, region in result.regions.items()],
+    }
+    data = [json.dumps(header).encode("utf-8"), b"\n"]
+    data.append(result.offsets.points.tobytes())
+    data.append(result.offsets.removed.tobytes())
+    for region in result.regions.values():
+        data.append(region.regions.tobytes())
+
+    return zlib.compress(b"".join(data))
+
+
+def ansi_cache_loads(data):
+    """
+    @brief Deserialize what ansi_cache_dumps returned.
+
+    @param data the bytes
+
+    @return (result, state, rules) the AnsiParseResult without its text, the SGR state at
+            the end of the text and the color scheme rules, None if the data is not valid
+    """
+
+    try:
+        data = zlib.decompress(data)
+        header, data = data.split(b"\n", 1)
+        header = json.loads(header.decode("utf-8"))
+        if header["version"] != ANSI_CACHE_VERSION or header["byteorder"] != sys.byteorder:
+            return None
+
+        def take(count):
+            nonlocal data
+            values = array("q")
+            values.frombytes(data[: count * values.itemsize])
+            data = data[count * values.itemsize :]
+            if len(values) != count:
+                raise ValueError("truncated")
+            return values
+
+        offsets = AnsiOffsetIndex()
+        offsets.points = take(header["offsets"])
+        offsets.removed = take(header["offsets"])
+        regions = {}
+        for scope, count in header["regions"]:
+            region = regions[scope] = AnsiRegion(scope)
+            region.regions = take(count)
+            region.spans = len(region)
+        state = AnsiState(*header["state"]) if header["state"] else None
+    except (ValueError, KeyError, TypeError, zlib.error):
+        return None
+
+    return AnsiParseResult("", regions, offsets), state, header["rules"]
+
+
+class AnsiStateTable(object):
+    """
+    The table of ansi_convert: the scope of a state is the state itself, so that the
+    regions of a sidecar do not depend on the ANSI_FG and ANSI_BG settings.
+    """
+
+    def scope(self, state):
+        return state
+
+
+def ansi_convert(source, target, sidecar, chunk_size=ANSI_CONVERT_CHUNK_SIZE):
+    """
+    @brief Strip the ansi codes of a text and write its regions to a sidecar, a chunk at
+           a time so that texts of any size are converted in bounded memory.
+
+    The sidecar is a zlib stream of blocks, each a JSON line followed by int64 values:
+    the header, then per chunk the states first used by it and its (state, a, b)
+    regions, then the size, sha1 and SGR state at the end of the stripped text.
+
+    @param source     the text file object to read the text from
+    @param target     the text file object to write the stripped text to
+    @param sidecar    the binary file object to write the regions to
+    @param chunk_size the number of characters read at a time
+
+    @return (size, regions) the number of characters and of regions written
+    """
+
+    stream = AnsiStream(AnsiStateTable())
+    compressor = zlib.compressobj()
+    digest = hashlib.sha1()
+    states = {}
+    size = count = 0
+
+    def write_block(header, values=None):
+        sidecar.write(compressor.compress(json.dumps(header).encode("utf-8") + b"\n"))
+        if values:
+            sidecar.write(compressor.compress(values.tobytes()))
+
+    write_block({"version": ANSI_SIDECAR_VERSION, "byteorder": sys.byteorder})
+    final = False
+    while not final:
+        data = source.read(chunk_size)
+        final = not data
+        result = stream.feed(data, final)
+
+        new_states = []
+        values = array("q")
+        for state, region in result.regions.items():
+            if state not in states:
+                states[state] = len(states)
+                new_states.append(state)
+            for a, b in region:
+                values.extend((states[state], a + size, b + size))
+        if values:
+            write_block({"states": new_states, "count": len(values) // 3}, values)
+            count += len(values) // 3
+
+        target.write(result.text)
+        digest.update(result.text.encode("utf-8"))
+        size += len(result.text)
+
+    write_block({"size": size, "digest": digest.hexdigest(), "state": stream.state})
+    sidecar.write(compressor.flush())
+
+    return size, count
+
+
+def ansi_sidecar_loads(data):
+    """
+    @brief Deserialize the sidecar written by ansi_convert.
+
+    @param data the bytes
+
+    @return (size, digest, state, regions) the size and sha1 of the stripped text, the
+            SGR state at its end and its {AnsiState: AnsiRegion} regions, None if the data
+            is not valid
+    """
+
+    try:
+        data = zlib.decompress(data)
+
+        def take_line(pos):
+            end = data.index(b"\n", pos)
+            return json.loads(data[pos:end].decode("utf-8")), end + 1
+
+        header, pos = take_line(0)
+        if header["version"] != ANSI_SIDECAR_VERSION or header["byteorder"] != sys.byteorder:
+            return None
+
+        states = []
+        regions = {}
+        while True:
+            block, pos = take_line(pos)
+            if "digest" in block:
+                break
+            states.extend(AnsiState(*state) for state in block["states"])
+            values = array("q")
+            end = pos + 3 * block["count"] * values.itemsize
+            values.frombytes(data[pos:end])
+            if len(values) != 3 * block["count"]:
+                raise ValueError("truncated")
+            pos = end
+            for i in range(0, len(values), 3):
+                state = states[values[i]]
+                if state not in regions:
+                    regions[state] = AnsiRegion(state)
+                regions[state].add(values[i + 1], values[i + 2])
+        state = AnsiState(*block["state"]) if block["state"] else None
+    except (ValueError, KeyError, TypeError, IndexError, zlib.error):
+        return None
+
+    return block["size"], block["digest"], state, regions
+
+
+def ansi_strip_edits(result, max_span=0):
+    """
+    @brief Group the removal of the ansi codes of a parse result into few replacements.
+
+    Neighbouring codes are coalesced into one replacement as long as it spans at most
+    max_span characters of the content, the replacement text is sliced from the already
+    stripped text.
+
+    @param result   the AnsiParseResult of the content
+    @param max_span the maximum number of content characters a replacement may span,
+                    0 (or less) for a single replacement covering all codes
+
+    @return list of (a, b, text) replacements, in descending order of the offsets into
+            the content
+    """
+
+    edits = []
+    if not result.offsets:
+        return edits
+
+    spans = result.offsets.spans()
+    group_begin, group_end = next(spans)
+    removed_before = 0
+    removed = group_end - group_begin
+    for a, b in spans:
+        if max_span > 0 and b - group_begin > max_span:
+            text = result.text[group_begin - removed_before : group_end - removed]
+            edits.append((group_begin, group_end, text))
+            group_begin = a
+            removed_before = removed
+        group_end = b
+        removed += b - a
+    text = result.text[group_begin - removed_before : group_end - removed]
+    edits.append((group_begin, group_end, text))
+    edits.reverse()
+
+    return edits
+
+
+class AnsiOffsetIndex(object):
+    """
+    Sorted index of the escape codes removed from a text, two integers per code.
+    """
+
+    __slots__ = ("points", "removed")
+
+    def __init__(self):
+        super(AnsiOffsetIndex, self).__init__()
+        # end of every removed code and the number of characters removed up to it
+        self.points = array("q")
+        self.removed = array("q")
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, a, b):
+        """
+        @brief Add a removed code, codes must be added in ascending order.
+
+        @param a the begin of the code
+        @param b the end of the code
+        """
+
+        self.points.append(b)
+        self.removed.append((self.removed[-1] if self.removed else 0) + b - a)
+
+    def spans(self):
+        """
+        @brief Iterate over the (a, b) spans of the removed codes.
+        """
+
+        removed = 0
+        for b, total in zip(self.points, self.removed):
+            yield b - (total - removed), b
+            removed = total
+
+    def total(self):
+        return self.removed[-1] if self.removed else 0
+
+    def extend(self, other, val):
+        """
+        @brief Append the codes of the index of a following text.
+
+        @param other the AnsiOffsetIndex of the following text
+        @param val   the offset of the following text into the text
+        """
+
+        total = self.total()
+        self.points.extend(array("q", [p + val for p in other.points]))
+        self.removed.extend(array("q", [r + total for r in other.removed]))
+
+
+class AnsiRegion(object):
+    """
+    The regions of a scope, stored as a flat array of integers (a0, b0, a1, b1, ...).
+
+    Regions must be added in ascending order, one touching or overlapping the last one is
+    merged into it (e.g. the same color code repeated for every word).
+    """
+
+    __slots__ = ("scope", "regions", "spans")
+
+    def __init__(self, scope):
+        super(AnsiRegion, self).__init__()
+        self.scope = scope
+        self.regions = array("q")
+        # the number of regions added, before merging
+        self.spans = 0
+
+    def __len__(self):
+        return len(self.regions) // 2
+
+    def __iter__(self):
+        points = iter(self.regions)
+        return zip(points, points)
+
+    def add(self, a, b):
+        self.spans += 1
+        if self.regions and a <= self.regions[-1]:
+            self.regions[-1] = max(self.regions[-1], b)
+            return
+        self.regions.append(a)
+        self.regions.append(b)
+
+    def shift(self, val):
+        self.regions = array("q", [p + val for p in self.regions])
+
+    def extend(self, other, val):
+        """
+        @brief Append the regions of a following text.
+
+        @param other the AnsiRegion of the following text
+        @param val   the offset of the following text into the text
+        """
+
+        regions = array("q", [p + val for p in other.regions])
+        self.spans += other.spans
+        if self.regions and regions and regions[0] <= self.regions[-1]:
+            # a region cut in two where the texts have been split
+            self.regions[-1] = max(self.regions[-1], regions[1])
+            regions = regions[2:]
+        self.regions.extend(regions)
+
+
+def ansi_region_counts(regions):
+    """
+    @brief Count the regions added to AnsiRegions before and after merging.
+
+    @param regions the AnsiRegions, e.g. the regions of an AnsiParseResult
+
+    @return (spans, regions) the numbers of regions added and kept
+    """
+
+    regions = list(regions)
+
+    return sum(region.spans for region in regions), sum(len(region) for region in regions)
+
+
+def ansi_region_key(scope, n):
+    """
+    @brief Get the key of the n-th bucket of regions of a scope.
+
+    @param scope the scope of the regions
+    @param n     the index of the bucket
+
+    @return str
+    """
+
+    return scope if not n else "{}#{}".format(scope, n)
+
+
+def ansi_slot_key(key, n):
+    """
+    @brief Get the key of the n-th slot of a bucket, see AnsiRegionStore.
+
+    @param key the key of the bucket
+    @param n   the index of the slot
+
+    @return str
+    """
+
+    return "{}~{}".format(key, n)
+
+
+class AnsiRegionStore(object):
+    """
+    Append-only storage of the ansi regions added to a view.
+
+    Adding regions to a key replaces all of its regions, therefore the regions of a scope
+    are spread over several keys (buckets) of at most bucket_size regions. The regions
+    appended to the last bucket of a scope are added under a key of their own (a slot),
+    so that an append only sends its own regions to the view, and the slots are merged
+    into the key of the bucket once ANSI_REGION_SLOTS of them are used. Every region is
+    therefore sent to the view about twice and the cost of an append does not grow with
+    the view's history.
+
+    Only the regions of the last buckets are kept, in AnsiRegions. The other buckets are
+    known by their first offset and number of regions, which is what trim() needs to drop
+    the oldest of them.
+    """
+
+    def __init__(self, bucket_size=ANSI_REGION_BUCKET_SIZE):
+        super(AnsiRegionStore, self).__init__()
+        self.bucket_size = bucket_size
+        self.buckets = {
+            # scope: keys,
+        }
+        self.tails = {
+            # scope: AnsiRegion of the last key, its slots included,
+        }
+        self.slots = {
+            # scope: number of slots of the last key,
+        }
+        self.splits = {
+            # scope: number of regions of the slots continuing a region of the last key,
+        }
+        self.restored = {
+            # scope: number of keys taken over by restore(),
+        }
+        self.sizes = {
+            # key: (begin, number of regions, scope),
+        }
+        # the number of regions of all the keys in sizes
+        self.size = 0
+
+    def append(self, scope, regions):
+        """
+        @brief Append regions of a scope.
+
+        @param scope   the scope of the regions
+        @param regions the (a, b) regions to append
+
+        @return (added, erased) the (key, regions) to (re)add and the keys to erase
+        """
+
+        keys = self.buckets.setdefault(scope, [])
+        tail = self.tails.get(scope)
+        regions = list(regions)
+        if not regions:
+            return [], []
+        # continues the last region, e.g. a text colored across two chunks of a build
+        continues = bool(tail and tail.regions[-2] <= regions[0][0] <= tail.regions[-1])
+        if tail is not None and len(tail) + len(regions) - continues <= self.bucket_size:
+            key = keys[-1]
+            self._extend(tail, regions)
+            slots = self.slots.get(scope, 0)
+            if slots < ANSI_REGION_SLOTS:
+                self.slots[scope] = slots + 1
+                # the continued region is merged in the tail but split in the view
+                split = self.splits[scope] = self.splits.get(scope, 0) + continues
+                self._resize(key, scope, tail.regions[0], len(tail) + split)
+                return [(ansi_slot_key(key, slots), regions)], []
+            self.slots[scope] = 0
+            self.splits.pop(scope, None)
+            self._resize(key, scope, tail.regions[0], len(tail))
+            return [(key, tail)], [ansi_slot_key(key, n) for n in range(slots)]
+
+        # the last key is left as it is, its slots merged into it
+        added, erased = self._merge_slots(scope)
+        keys.append(ansi_region_key(scope, len(keys)))
+        if len(regions) >= self.bucket_size:
+            # too large to be appended to, never keep a copy of it
+            self.tails.pop(scope, None)
+            self._resize(keys[-1], scope, regions[0][0], len(regions))
+            added.append((keys[-1], regions))
+            return added, erased
+        tail = self.tails[scope] = AnsiRegion(scope)
+        self._extend(tail, regions)
+        self._resize(keys[-1], scope, tail.regions[0], len(tail))
+        added.append((keys[-1], tail))
+
+        return added, erased
+
+    def _extend(self, tail, regions):
+        for a, b in regions:
+            if tail.regions and a <= tail.regions[-1]:
+                tail.regions[-1] = max(tail.regions[-1], b)
+            else:
+                tail.regions.append(a)
+                tail.regions.append(b)
+
+    def _merge_slots(self, scope):
+        slots = self.slots.pop(scope, 0)
+        if not slots:
+            return [], []
+        key = self.buckets[scope][-1]
+        if self.splits.pop(scope, 0):
+            tail = self.tails[scope]
+            self._resize(key, scope, tail.regions[0], len(tail))
+
+        return [(key, self.tails[scope])], [ansi_slot_key(key, n) for n in range(slots)]
+
+    def _resize(self, key, scope, begin, count):
+        self.size += count - self.sizes.get(key, (0, 0, None))[1]
+        self.sizes[key] = (begin, count, scope)
+
+    def trim(self, limit):
+        """
+        @brief Drop the keys at the lowest offsets, i.e. the oldest output of a build, once
+               the store holds more than limit regions.
+
+        The store is trimmed down to 90% of the limit, so that the keys are not sorted
+        again by every append.
+
+        @param limit the maximum number of regions, 0 for no limit
+
+        @return The dropped keys, whose regions have to be erased from the view.
+        """
+
+        if not limit or self.size <= limit:
+            return []
+
+        dropped = []
+        for key, (_, count, scope) in sorted(self.sizes.items(), key=lambda item: item[1][0]):
+            if self.size <= limit * 9 // 10:
+                break
+            dropped.append(key)
+            del self.sizes[key]
+            self.size -= count
+            if self.buckets[scope][-1] == key:
+                # the next regions of the scope go to a new key
+                self.tails.pop(scope, None)
+                self.splits.pop(scope, None)
+                dropped.extend(ansi_slot_key(key, n) for n in range(self.slots.pop(scope, 0)))
+
+        return dropped
+
+    def shift(self, begin, val):
+        """
+        @brief Shift the kept regions beginning at or after an offset.
+
+        To be called when the text of the view before regions already added changes.
+
+        @param begin the offset
+        @param val   the number of characters to shift the regions by
+        """
+
+        for tail in self.tails.values():
+            regions = tail.regions
+            for n in range(0, len(regions), 2):
+                if regions[n] >= begin:
+                    regions[n] += val
+                    regions[n + 1] += val
+        for key, (a, count, scope) in self.sizes.items():
+            if a >= begin:
+                self.sizes[key] = (a + val, count, scope)
+
+    def keys(self):
+        for scope, keys in self.buckets.items():
+            for key in keys:
+                yield key
+            # the slots of the keys taken over are not known, any of them may be in use
+            for key in keys[: self.restored.get(scope, 0)]:
+                for n in range(ANSI_REGION_SLOTS):
+                    yield ansi_slot_key(key, n)
+            for n in range(self.slots.get(scope, 0)):
+                yield ansi_slot_key(keys[-1], n)
+
+    def counts(self):
+        """
+        @brief Get the number of keys of every scope, which is enough to rebuild them.
+
+        @return dict scope: count
+        """
+
+        return {scope: len(keys) for scope, keys in self.buckets.items()}
+
+    def restore(self, counts):
+        """
+        @brief Take over the keys of another store, e.g. after a plugin reload.
+
+        The regions of these keys are not known, new regions are appended to new keys and
+        only these count for trim().
+
+        @param counts the counts() of the other store
+        """
+
+        for scope, count in counts.items():
+            self.buckets[scope] = [ansi_region_key(scope, n) for n in range(count)]
+            self.restored[scope] = count
+            self.tails.pop(scope, None)
+            self.slots.pop(scope, None)
+            self.splits.pop(scope, None)
+
+
+class AnsiDefinitionTable(object):
+    """
+    The ANSI_FG and ANSI_BG settings compiled for the lookup of the scope of a state.
+
+    A table is built once per revision of the settings and shared by all the parsing
+    done with it, the scopes of the states seen so far are cached.
+    """
+
+    def __init__(self, fgs, bgs):
+        super(AnsiDefinitionTable, self).__init__()
+        self.fgs = fgs
+        self.bgs = bgs
+        # changes with the entries, e.g. to tell results cached with other settings
+        entries = json.dumps([fgs, bgs], sort_keys=True).encode("utf-8")
+        self.revision = hashlib.sha1(entries).hexdigest()
+        self.fg_regexes = [(re.compile(fg["code"]), fg) for fg in fgs]
+        self.bg_regexes = [(re.compile(bg["code"]), bg) for bg in bgs]
+        self.scopes = {
+            # state: scope,
+        }
+        self.rules = {
+            # scope: color scheme rule of a scope allocated on demand,
+        }
+        self._definitions = None
+
+    def matches(self, fgs, bgs):
+        """
+        @brief Check whether the table has been built from these settings entries.
+
+        @param fgs the ANSI_FG settings entries
+        @param bgs the ANSI_BG settings entries
+
+        @return bool
+        """
+
+        return self.fgs == fgs and self.bgs == bgs
+
+    def definitions(self):
+        """
+        @brief Get the definition of every ANSI_FG and ANSI_BG combination.
+
+        @return AnsiDefinition[]
+        """
+
+        if self._definitions is None:
+            self._definitions = list(ansi_definitions(self.fgs, self.bgs))
+
+        return self._definitions
+
+    def scope(self, state):
+        """
+        @brief Get the scope of a state.
+
+        The basic colors are looked up in the ANSI_FG and ANSI_BG settings entries, the
+        state is turned back into the canonical escape codes the entries are written for,
+        so that e.g. bold red matches "\\x1b[1;31m" (red_light) and falls back to
+        "\\x1b[31m" with the "_bold" background entry.
+
+        The states the fg x bg scopes of the settings cannot express (rgb colors, italic,
+        underline, inverse) get a scope allocated on demand, named after the colors and
+        font styles it renders, whose color scheme rule is added to rules.
+
+        @param state the AnsiState
+
+        @return The scope name or None if no entries match.
+        """
+
+        if state in self.scopes:
+            return self.scopes[state]
+        if len(self.scopes) >= ANSI_CACHE_SIZE:
+            self.scopes.clear()
+
+        if (
+            state.italic
+            or state.underline
+            or state.inverse
+            or ansi_is_rgb(state.fg)
+            or ansi_is_rgb(state.bg)
+        ):
+            scope = self._rule_scope(state)
+        else:
+            entries = self._find_entries(state.fg, state.bg, state.bold)
+            scope = "{0}{1}".format(entries[0]["scope"], entries[1]["scope"]) if entries else None
+        self.scopes[state] = scope
+
+        return scope
+
+    def _find_entries(self, fg, bg, bold):
+        def find(regexes, code):
+            for regex_obj, definition in regexes:
+                if regex_obj.fullmatch(code):
+                    return definition
+            return None
+
+        if fg and bold:
+            fg_candidates = [
+                ("\x1b[1;{}m".format(fg), False),
+                ("\x1b[{}m".format(fg), True),
+            ]
+        elif fg:
+            fg_candidates = [("\x1b[{}m".format(fg), False)]
+        elif bold:
+            fg_candidates = [("\x1b[1m", False)]
+        else:
+            fg_candidates = [("\x1b[m", False)]
+
+        for fg_code, bold_left in fg_candidates:
+            fg_entry = find(self.fg_regexes, fg_code)
+            if fg_entry is not None:
+                break
+        else:
+            return None
+
+        if bg:
+            bg_candidates = ["\x1b[{}m".format(bg)]
+        elif bold_left:
+            bg_candidates = ["\x1b[1m", ""]
+        else:
+            bg_candidates = [""]
+
+        for bg_code in bg_candidates:
+            bg_entry = find(self.bg_regexes, bg_code)
+            if bg_entry is not None:
+                return fg_entry, bg_entry, bold_left
+
+        return None
+
+    def _rule_scope(self, state):
+        fg_rgb = ansi_is_rgb(state.fg)
+        bg_rgb = ansi_is_rgb(state.bg)
+        entries = self._find_entries(
+            None if fg_rgb else state.fg, None if bg_rgb else state.bg, state.bold
+        )
+        if entries is None:
+            return None
+        fg_entry, bg_entry, bold_left = entries
+
+        fg = state.fg if fg_rgb else fg_entry["color"]
+        bg = state.bg if bg_rgb else bg_entry["color"]
+        if state.inverse:
+            fg, bg = bg, fg
+        styles = []
+        if bold_left or "bold" in (fg_entry.get("font_style"), bg_entry.get("font_style")):
+            styles.append("bold")
+        if state.italic:
+            styles.append("italic")
+        if state.underline:
+            styles.append("underline")
+
+        scope = ".".join(
+            ["ansi", re.sub(r"\W", "", fg).lower(), re.sub(r"\W", "", bg).lower()] + styles
+        )
+        if scope not in self.rules:
+            rule = {"scope": scope, "foreground": fg, "background": bg}
+            if styles:
+                rule["font_style"] = " ".join(styles)
+            self.rules[scope] = rule
+
+        return scope
+
+    def prune_rules(self, scopes):
+        """
+        @brief Drop the rules of scopes allocated on demand, their states are given a scope
+               again if they are seen again.
+
+        @param scopes the scopes to drop
+        """
+
+        for scope in scopes:
+            self.rules.pop(scope, None)
+        for state, scope in list(self.scopes.items()):
+            if scope in scopes:
+                del self.scopes[state]
+
+
+class AnsiStream(object):
+    """
+    Incremental ansi_parse of a text received in chunks (e.g. the output of a build).
+
+    The SGR state and an escape code split at the end of a chunk are carried over to the
+    next chunk, so the result does not depend on where the text has been split.
+    """
+
+    def __init__(self, table):
+        super(AnsiStream, self).__init__()
+        self.table = table
+        self.state = None
+        self.pending = ""
+
+    def feed(self, data, final=False):
+        """
+        @brief Parse the next chunk of the text.
+
+        @param data  the next chunk
+        @param final whether this is the last chunk, an incomplete escape code at its end
+                     is then kept as text instead of waiting for the rest of it
+
+        @return AnsiParseResult of the chunk, the regions are offsets into the stripped
+                text of the chunk and the offset index maps offsets into the chunk,
+                prefixed by the incomplete code of the previous chunk
+        """
+
+        content = self.pending + data
+        end = len(content)
+        if not final:
+            # hold back a trailing escape code which may be completed by the next chunk
+            end = ansi_split_point(content)
+        self.pending = content[end:]
+
+        ansi_regions = {
+            # scope: AnsiRegion,
+        }
+        chunks = []
+        offsets = AnsiOffsetIndex()
+
+        def add_text(state, a, b, removed):
+            if a >= b:
+                return
+            chunks.append(content[a:b])
+            if state is None:
+                return
+            scope = self.table.scope(state)
+            if scope is not None:
+                if scope not in ansi_regions:
+                    ansi_regions[scope] = AnsiRegion(scope)
+                ansi_regions[scope].add(a - removed, b - removed)
+
+        state = self.state
+        begin = removed = 0
+        for m in get_regex_obj(ANSI_CODE_REGEX).finditer(content, 0, end):
+            add_text(state, begin, m.start(), removed)
+            offsets.add(m.start(), m.end())
+            removed += m.end() - m.start()
+            state = ansi_next_state(state, m.group(1))
+            begin = m.end()
+        add_text(state, begin, end, removed)
+        self.state = state
+
+        return AnsiParseResult("".join(chunks), ansi_regions, offsets)
+
+    def flush(self):
+        """
+        @brief Finish the text, an incomplete escape code left pending is kept as text.
+
+        @return AnsiParseResult of the pending text
+        """
+
+        return self.feed("", final=True)
+
+
+class AnsiPhase(object):
+    """
+    Timing of one run of a phase, to be used as a context manager.
+
+    The counters are set by the code of the phase and recorded with its wall time.
+    """
+
+    __slots__ = ("stats", "name", "start", "chars", "codes", "regions")
+
+    def __init__(self, stats, name):
+        super(AnsiPhase, self).__init__()
+        self.stats = stats
+        self.name = name
+        self.start = 0.0
+        self.chars = self.codes = self.regions = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.record(
+            self.name, time.perf_counter() - self.start, self.chars, self.codes, self.regions
+        )
+
+
+class AnsiNullPhase(object):
+    """
+    The phase of disabled AnsiStats, its counters read as 0 and ignore assignments, so that
+    the shared ANSI_NULL_PHASE keeps no state across runs.
+    """
+
+    __slots__ = ()
+
+    chars = codes = regions = 0
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+ANSI_NULL_PHASE = AnsiNullPhase()
+
+
+class AnsiStats(object):
+    """
+    Rolling statistics of the phases of the colorization.
+
+    Every phase keeps its number of runs and its last ANSI_STATS_WINDOW samples of
+    (seconds, chars, codes, regions). When disabled, phase() returns a shared no-op
+    context manager, so that instrumented code costs a call and an attribute lookup.
+    """
+
+    def __init__(self, enabled=False):
+        super(AnsiStats, self).__init__()
+        self.enabled = enabled
+        self.phases = {
+            # name: [runs, deque of samples],
+        }
+
+    def phase(self, name):
+        """
+        @brief Time a run of a phase.
+
+        @param name the name of the phase
+
+        @return AnsiPhase whose chars, codes and regions counters can be set
+        """
+
+        if not self.enabled:
+            return ANSI_NULL_PHASE
+        return AnsiPhase(self, name)
+
+    def record(self, name, seconds, chars=0, codes=0, regions=0):
+        if not self.enabled:
+            return
+        if name not in self.phases:
+            self.phases[name] = [0, deque(maxlen=ANSI_STATS_WINDOW)]
+        entry = self.phases[name]
+        entry[0] += 1
+        entry[1].append((seconds, chars, codes, regions))
+
+    def reset(self):
+        self.phases.clear()
+
+    def report(self):
+        """
+        @brief Format the statistics of every phase as a table.
+
+        @return str
+        """
+
+        lines = [
+            "{:<16} {:>7} {:>10} {:>10} {:>10} {:>12} {:>10} {:>10} {:>9}".format(
+                "phase",
+                "runs",
+                "mean ms",
+                "max ms",
+                "total ms",
+                "chars",
+                "codes",
+                "regions",
+                "MB/s",
+            )
+        ]
+        for name, (runs, samples) in sorted(self.phases.items()):
+            seconds = sum(sample[0] for sample in samples)
+            chars = sum(sample[1] for sample in samples)
+            lines.append(
+                "{:<16} {:>7} {:>10.2f} {:>10.2f} {:>10.1f} {:>12} {:>10} {:>10} {:>9}".format(
+                    name,
+                    runs,
+                    1000 * seconds / len(samples),
+                    1000 * max(sample[0] for sample in samples),
+                    1000 * seconds,
+                    chars,
+                    sum(sample[2] for sample in samples),
+                    sum(sample[3] for sample in samples),
+                    "{:.1f}".format(chars / seconds / 1e6) if chars and seconds else "-",
+                )
+            )
+        if not self.phases:
+            lines.append("no samples, set ANSI_stats to true to record them")
+        else:
+            lines.append(
+                "\nthe columns after runs cover the last {} runs of each phase".format(
+                    ANSI_STATS_WINDOW
+                )
+            )
+
+        return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Strip the ansi escape codes of a log and write its regions to a sidecar "
+        "file, which ANSIescape applies when the stripped log is opened."
+    )
+    parser.add_argument("input", help="the ansi colored log, - for stdin")
+    parser.add_argument(
+        "output", help="the stripped log, its regions go to OUTPUT" + ANSI_SIDECAR_SUFFIX
+    )
+    parser.add_argument("--encoding", default="utf-8", help="the encoding of the log")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=ANSI_CONVERT_CHUNK_SIZE,
+        help="the number of characters read at a time",
+    )
+    args = parser.parse_args(argv)
+
+    # the line endings are normalized to \n as in the views, so that the offsets match
+    if args.input == "-":
+        source = io.TextIOWrapper(sys.stdin.buffer, encoding=args.encoding, errors="replace")
+    else:
+        source = open(args.input, encoding=args.encoding, errors="replace")
+    with source, open(args.output, "w", encoding="utf-8", newline="") as target:
+        with open(args.output + ANSI_SIDECAR_SUFFIX, "wb") as sidecar:
+            size, count = ansi_convert(source, target, sidecar, args.chunk_size)
+    print("{} characters, {} regions".format(size, count), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
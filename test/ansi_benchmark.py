@@ -0,0 +1,677 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the ANSIescape processing paths outside of Sublime Text.
+
+A minimal stand-in for the sublime, sublime_plugin and Default.exec modules is installed
+before the plugin is imported, a synthetic ANSI colored log is generated and the time
+(and memory) needed to process it is reported for:
+
+ - file:      AnsiCommand over the whole log (opening a file), including the background
+              batches of a lazily colorized log
+ - on_data:   AnsiColorBuildCommand.on_data_process for every chunk of the log
+ - on_batch:  AnsiColorBuildCommand.on_data_batch for every chunk of the log, the chunks
+              being received faster than ANSI_batch_latency
+ - on_finish: AnsiColorBuildCommand.on_finished after the raw log has been received
+
+Usage: ansi_benchmark.py [options]  (see --help)
+"""
+
+import argparse
+import importlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from collections import OrderedDict
+
+PACKAGE_NAME = "ANSIescape"
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATHS = ["file", "on_data", "on_batch", "on_finish"]
+
+WORDS = (
+    "build compile link test passed failed warning error module target cache object "
+    "running finished skipped collected artifact deploy step docker layer crate"
+).split()
+FG_CODES = [str(c) for c in list(range(30, 38)) + list(range(90, 98))]
+BG_CODES = [str(c) for c in list(range(40, 48)) + list(range(100, 108))]
+
+
+# --------------------------------------------------------------------------------------
+# sublime API stand-in
+# --------------------------------------------------------------------------------------
+
+
+class PhaseTimer(object):
+    """Accumulate the wall time spent in wrapped functions (inclusive of nested phases)."""
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    def reset(self):
+        self.phases.clear()
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+        return timed
+
+
+TIMER = PhaseTimer()
+# the regions parsed before and after merging the touching ones
+SPANS = OrderedDict([("spans", 0), ("merged", 0)])
+
+
+def count_spans(func):
+    def counted(*args, **kwargs):
+        result = func(*args, **kwargs)
+        for region in result.regions.values():
+            SPANS["spans"] += region.spans
+            SPANS["merged"] += len(region)
+        return result
+
+    return counted
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def __iter__(self):
+        return iter((self.a, self.b))
+
+    def __repr__(self):
+        return "Region({}, {})".format(self.a, self.b)
+
+    def __eq__(self, other):
+        return (self.a, self.b) == (other.a, other.b)
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return abs(self.b - self.a)
+
+    def empty(self):
+        return self.a == self.b
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+
+class Settings(object):
+    def __init__(self, values=None):
+        self._values = dict(values or {})
+        self._callbacks = OrderedDict()
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def has(self, key):
+        return key in self._values
+
+    def set(self, key, value):
+        self._values[key] = value
+        for callback in list(self._callbacks.values()):
+            callback()
+
+    def erase(self, key):
+        self._values.pop(key, None)
+
+    def add_on_change(self, tag, callback):
+        self._callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self._callbacks.pop(tag, None)
+
+
+class Window(object):
+    """The window of the views which have been opened with open_view()."""
+
+    _next_id = 0
+
+    def __init__(self):
+        Window._next_id += 1
+        self._id = Window._next_id
+        self._views = []
+
+    def id(self):
+        return self._id
+
+    def views(self):
+        return list(self._views)
+
+    def panels(self):
+        return []
+
+    def find_output_panel(self, name):
+        return None
+
+    def run_command(self, cmd, args=None):
+        pass
+
+    def open_view(self, view):
+        view._window = self
+        self._views.append(view)
+        return view
+
+
+class View(object):
+    """
+    A text buffer implementing the View methods used by the plugin.
+
+    Erasing in descending order (as the plugin does) is deferred and applied in a single
+    join on the next read, so the stub itself does not make per code erasing quadratic.
+    """
+
+    _next_id = 0
+    commands = {}
+    # the first visible character
+    viewport = 0
+
+    def __init__(self, text="", file_name=None):
+        View._next_id += 1
+        self._id = View._next_id
+        self._file_name = file_name
+        self._window = None
+        self._text = text
+        self._size = len(text)
+        self._erased = []
+        self._regions = {}
+        self._scopes = {}
+        self._settings = Settings()
+        self._scratch = False
+        self._read_only = False
+        self._status = {}
+        self._change_count = 0
+
+    def _flush(self):
+        if not self._erased:
+            return
+        end = len(self._text)
+        kept = []
+        for a, b in self._erased:
+            kept.append(self._text[b:end])
+            end = a
+        kept.append(self._text[:end])
+        self._text = "".join(reversed(kept))
+        self._erased = []
+
+    def _changed(self):
+        self._change_count += 1
+
+    def id(self):
+        return self._id
+
+    def buffer_id(self):
+        return self._id
+
+    def name(self):
+        return "benchmark"
+
+    def file_name(self):
+        return self._file_name
+
+    def window(self):
+        return self._window
+
+    def size(self):
+        return self._size
+
+    def change_count(self):
+        return self._change_count
+
+    def settings(self):
+        return self._settings
+
+    def is_scratch(self):
+        return self._scratch
+
+    def set_scratch(self, value):
+        self._scratch = value
+
+    def is_read_only(self):
+        return self._read_only
+
+    def set_read_only(self, value):
+        self._read_only = value
+
+    def is_loading(self):
+        return False
+
+    def set_status(self, key, value):
+        self._status[key] = value
+
+    def erase_status(self, key):
+        self._status.pop(key, None)
+
+    def visible_region(self):
+        return Region(self.viewport, min(self._size, self.viewport + 8000))
+
+    def text(self):
+        self._flush()
+        return self._text
+
+    def substr(self, region):
+        self._flush()
+        if isinstance(region, int):
+            return self._text[region : region + 1]
+        return self._text[region.begin() : region.end()]
+
+    def find(self, pattern, start_point, flags=0):
+        self._flush()
+        begin = self._text.find(pattern, start_point)
+        return Region(begin, begin + len(pattern) if begin >= 0 else -1)
+
+    def erase(self, edit, region):
+        a, b = region.begin(), region.end()
+        if self._erased and b > self._erased[-1][0]:
+            self._flush()
+        self._erased.append((a, b))
+        self._size -= b - a
+        self._changed()
+
+    def insert(self, edit, point, text):
+        self._flush()
+        self._text = self._text[:point] + text + self._text[point:]
+        self._size = len(self._text)
+        self._changed()
+        return len(text)
+
+    def replace(self, edit, region, text):
+        self._flush()
+        self._text = self._text[: region.begin()] + text + self._text[region.end() :]
+        self._size = len(self._text)
+        self._changed()
+        self._shift_regions(region.end(), len(text) - region.size())
+
+    def _shift_regions(self, begin, val):
+        # like Sublime Text, regions following a modification move with the text
+        if val == 0:
+            return
+        for regions in self._regions.values():
+            for r in regions:
+                if r.a >= begin:
+                    r.a += val
+                    r.b += val
+
+    def append(self, text):
+        self._flush()
+        self._text += text
+        self._size = len(self._text)
+        self._changed()
+
+    def reload(self, text):
+        # like Sublime Text reloading a file modified on disk, the regions are kept
+        self._flush()
+        self._text = text
+        self._size = len(text)
+        self._changed()
+
+    def add_regions(self, key, regions, scope="", icon="", flags=0):
+        self._regions[key] = [Region(r.a, r.b) for r in regions]
+        self._scopes[key] = scope
+
+    def get_regions(self, key):
+        return [Region(r.a, r.b) for r in self._regions.get(key, [])]
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+        self._scopes.pop(key, None)
+
+    def region_count(self):
+        return sum(len(regions) for regions in self._regions.values())
+
+    def run_command(self, cmd, args=None):
+        self.commands[cmd](self).run(None, **(args or {}))
+
+
+def load_settings_file(path):
+    """Read a .sublime-settings file (JSON with comments and trailing commas)."""
+
+    with open(path) as file:
+        content = file.read()
+    content = re.sub(r"^\s*//.*$", "", content, flags=re.MULTILINE)
+    content = re.sub(r",(\s*[}\]])", r"\1", content)
+    return json.loads(content)
+
+
+def install_sublime_stubs():
+    pending = []
+    windows = [Window()]
+
+    sublime = types.ModuleType("sublime")
+    sublime.Region = Region
+    sublime.View = View
+    sublime.Window = Window
+    sublime.DRAW_NO_OUTLINE = 256
+    sublime.PERSISTENT = 16
+    sublime.LITERAL = 1
+    sublime.pending_timeouts = pending
+    sublime.set_timeout = lambda callback, delay=0: pending.append(callback)
+    sublime.set_timeout_async = lambda callback, delay=0: pending.append(callback)
+    sublime.windows = lambda: list(windows)
+    sublime.active_window = lambda: windows[0]
+    sublime.status_message = lambda msg: None
+    sublime.error_message = lambda msg: print(msg, file=sys.stderr)
+    packages_path = tempfile.mkdtemp(prefix="ansi_benchmark_")
+    sublime.packages_path = lambda: packages_path
+    # where the plugin writes its color scheme
+    os.makedirs(os.path.join(packages_path, "User", PACKAGE_NAME))
+
+    settings = Settings(load_settings_file(os.path.join(PACKAGE_DIR, "ansi.sublime-settings")))
+    sublime.load_settings = lambda name: settings
+    sublime.save_settings = lambda name: None
+
+    sublime_plugin = types.ModuleType("sublime_plugin")
+
+    class TextCommand(object):
+        def __init__(self, view):
+            self.view = view
+
+    class WindowCommand(object):
+        def __init__(self, window):
+            self.window = window
+
+    class EventListener(object):
+        pass
+
+    sublime_plugin.TextCommand = TextCommand
+    sublime_plugin.WindowCommand = WindowCommand
+    sublime_plugin.EventListener = EventListener
+
+    class ExecCommand(object):
+        def on_data(self, proc, data):
+            self.output_view.append(data)
+
+        def on_finished(self, proc):
+            pass
+
+    default = types.ModuleType("Default")
+    default_exec = types.ModuleType("Default.exec")
+    default_exec.ExecCommand = ExecCommand
+    default.exec = default_exec
+
+    sys.modules.update(
+        {
+            "sublime": sublime,
+            "sublime_plugin": sublime_plugin,
+            "Default": default,
+            "Default.exec": default_exec,
+        }
+    )
+
+    return sublime
+
+
+def run_pending_timeouts(sublime):
+    while sublime.pending_timeouts:
+        sublime.pending_timeouts.pop(0)()
+
+
+def load_plugin():
+    """Import the plugin as the ANSIescape package like Sublime Text does."""
+
+    install_sublime_stubs()
+    package = types.ModuleType(PACKAGE_NAME)
+    package.__path__ = [PACKAGE_DIR]
+    sys.modules[PACKAGE_NAME] = package
+    ansi = importlib.import_module(PACKAGE_NAME + ".ansi")
+
+    for name in dir(ansi):
+        obj = getattr(ansi, name)
+        if isinstance(obj, type) and name.endswith("Command") and hasattr(obj, "run"):
+            cmd = "_".join(re.findall(r"[A-Z][^A-Z]*", name[: -len("Command")])).lower()
+            View.commands[cmd] = obj
+
+    return ansi
+
+
+def instrument(ansi):
+    """Wrap the functions of interest with the phase timer."""
+
+    engine = sys.modules[PACKAGE_NAME + ".ansi_engine"]
+    ansi.parse_ansi_text = TIMER.wrap("parse_ansi_text", ansi.parse_ansi_text)
+    ansi.apply_ansi_result = TIMER.wrap("apply_ansi_result", ansi.apply_ansi_result)
+    engine.AnsiStream.feed = TIMER.wrap("AnsiStream.feed", count_spans(engine.AnsiStream.feed))
+    for method in ("substr", "erase", "replace", "add_regions", "get_regions", "erase_regions"):
+        setattr(View, method, TIMER.wrap("View." + method, getattr(View, method)))
+    View.run_command = TIMER.wrap("View.run_command", View.run_command)
+    # the time to the first paint of large files which are colorized lazily
+    ansi.AnsiCommand.run = TIMER.wrap("AnsiCommand.run", ansi.AnsiCommand.run)
+
+
+# --------------------------------------------------------------------------------------
+# synthetic logs
+# --------------------------------------------------------------------------------------
+
+
+def generate_log(size, density=0.2, bg_ratio=0.2, bold_ratio=0.3, seed=0):
+    """
+    Generate an ANSI colored log of about `size` characters.
+
+    @param size       the number of characters to generate
+    @param density    the probability of a word being colored
+    @param bg_ratio   the probability of a colored word having a background color
+    @param bold_ratio the probability of a colored word being bold
+    @param seed       the random seed
+    """
+
+    rand = random.Random(seed)
+    lines = []
+    length = 0
+    n = 0
+    while length < size:
+        n += 1
+        words = ["[{:08d}]".format(n)]
+        for _ in range(rand.randint(4, 16)):
+            word = rand.choice(WORDS)
+            if rand.random() < density:
+                params = [rand.choice(FG_CODES)]
+                if rand.random() < bold_ratio:
+                    params.insert(0, "1")
+                if rand.random() < bg_ratio:
+                    bg = rand.choice(BG_CODES)
+                    # tools emit both combined and separate codes
+                    if rand.random() < 0.5:
+                        params.append(bg)
+                        word = "\x1b[{}m{}\x1b[0m".format(";".join(params), word)
+                    else:
+                        word = "\x1b[{}m\x1b[{}m{}\x1b[0m".format(";".join(params), bg, word)
+                else:
+                    word = "\x1b[{}m{}\x1b[0m".format(";".join(params), word)
+            words.append(word)
+        line = " ".join(words) + "\n"
+        lines.append(line)
+        length += len(line)
+
+    return "".join(lines)
+
+
+def split_chunks(text, chunk_size):
+    return [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+# --------------------------------------------------------------------------------------
+# benchmarks
+# --------------------------------------------------------------------------------------
+
+
+def new_output_view(text="", file_name=None):
+    view = View(text, file_name)
+    view.settings().set("syntax", "Packages/ANSIescape/ANSI.sublime-syntax")
+    return view
+
+
+def bench_file(ansi, text, chunks):
+    view = new_output_view(text)
+    start = time.perf_counter()
+    view.run_command("ansi")
+    run_pending_timeouts(sys.modules["sublime"])
+    return time.perf_counter() - start, view
+
+
+def bench_on_data(ansi, text, chunks):
+    view = new_output_view()
+    build = ansi.AnsiColorBuildCommand()
+    build.output_view = view
+    build.process_trigger = "on_data"
+    start = time.perf_counter()
+    for chunk in chunks:
+        build.on_data(None, chunk)
+    build.on_finished(None)
+    return time.perf_counter() - start, view
+
+
+def bench_on_batch(ansi, text, chunks):
+    view = new_output_view()
+    build = ansi.AnsiColorBuildCommand()
+    build.output_view = view
+    build.process_trigger = "on_batch"
+    start = time.perf_counter()
+    for chunk in chunks:
+        build.on_data(None, chunk)
+    build.on_finished(None)
+    # the batches are processed by timeouts
+    run_pending_timeouts(sys.modules["sublime"])
+    return time.perf_counter() - start, view
+
+
+def bench_on_finish(ansi, text, chunks):
+    view = new_output_view()
+    build = ansi.AnsiColorBuildCommand()
+    build.output_view = view
+    build.process_trigger = "on_finish"
+    for chunk in chunks:
+        build.on_data(None, chunk)
+    TIMER.reset()
+    start = time.perf_counter()
+    build.on_finished(None)
+    # the lazy batches of a large output are processed by timeouts
+    run_pending_timeouts(sys.modules["sublime"])
+    return time.perf_counter() - start, view
+
+
+BENCHMARKS = OrderedDict(
+    [
+        ("file", bench_file),
+        ("on_data", bench_on_data),
+        ("on_batch", bench_on_batch),
+        ("on_finish", bench_on_finish),
+    ]
+)
+
+
+def measure(ansi, path, text, chunks, repeat, memory):
+    sublime = sys.modules["sublime"]
+    best = None
+    for _ in range(repeat):
+        TIMER.reset()
+        SPANS.update(spans=0, merged=0)
+        elapsed, view = BENCHMARKS[path](ansi, text, chunks)
+        run_pending_timeouts(sublime)
+        if best is None or elapsed < best["seconds"]:
+            best = {
+                "seconds": elapsed,
+                "phases": OrderedDict(TIMER.phases),
+                "regions": view.region_count(),
+                "spans": SPANS["spans"],
+                "merged": SPANS["merged"],
+                "size": view.size(),
+            }
+
+    if memory:
+        tracemalloc.start()
+        BENCHMARKS[path](ansi, text, chunks)
+        run_pending_timeouts(sublime)
+        best["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return best
+
+
+def report(results, info):
+    print(
+        "input: {size:.2f} MB, {codes} codes, {chunks} chunks of {chunk_size} chars".format_map(
+            info
+        )
+    )
+    for path, result in results.items():
+        print("\n{}".format(path))
+        print("  wall time   {:10.3f} s".format(result["seconds"]))
+        print("  throughput  {:10.2f} MB/s".format(info["size"] / result["seconds"]))
+        if "peak_memory" in result:
+            print("  peak memory {:10.2f} MB".format(result["peak_memory"] / 1024 / 1024))
+        print("  regions     {:10d}".format(result["regions"]))
+        if result["spans"]:
+            print(
+                "  merged      {:10d} of {} spans ({:.0%})".format(
+                    result["merged"], result["spans"], result["merged"] / result["spans"]
+                )
+            )
+        for phase, seconds in result["phases"].items():
+            print("  {:<24} {:10.3f} s".format(phase, seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--input", help="benchmark this file instead of a synthetic log")
+    parser.add_argument("--size", type=float, default=2.0, help="synthetic log size in MB")
+    parser.add_argument("--density", type=float, default=0.2, help="colored word ratio")
+    parser.add_argument("--bg-ratio", type=float, default=0.2, help="background color ratio")
+    parser.add_argument("--bold-ratio", type=float, default=0.3, help="bold color ratio")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="build output chunk size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per path, best is kept")
+    parser.add_argument("--paths", default=",".join(PATHS), help="comma separated paths")
+    parser.add_argument("--no-memory", action="store_true", help="skip peak memory tracing")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    ansi = load_plugin()
+    instrument(ansi)
+
+    if args.input:
+        with open(args.input, encoding="utf-8", errors="replace") as file:
+            text = file.read()
+    else:
+        text = generate_log(
+            int(args.size * 1024 * 1024), args.density, args.bg_ratio, args.bold_ratio, args.seed
+        )
+    chunks = split_chunks(text, args.chunk_size)
+
+    info = {
+        "size": len(text) / 1024 / 1024,
+        "codes": len(re.findall(r"\x1b\[[0-9;]*m", text)),
+        "chunks": len(chunks),
+        "chunk_size": args.chunk_size,
+    }
+    results = OrderedDict()
+    for path in args.paths.split(","):
+        results[path] = measure(ansi, path, text, chunks, args.repeat, not args.no_memory)
+
+    report(results, info)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"input": info, "results": results}, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+Check that the ways ANSIescape processes a text agree with a one-shot ansi_parse of
+ansi_test_file.txt: the chunks of a build, the parallel parse of large files, the sidecar
+of ansi_convert and the buckets of an AnsiRegionStore.
+
+The regions are compared by the text they color, i.e. per scope with the touching
+regions merged, as the regions of a scope may be split differently by each path.
+
+Usage: python -m unittest discover -s test
+"""
+
+import io
+import json
+import os
+import re
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+import ansi_engine  # noqa: E402
+
+CHUNK_SIZES = [1, 7, 64, 1000]
+
+
+def load_settings_file(path):
+    """Read a .sublime-settings file (JSON with comments and trailing commas)."""
+
+    with open(path) as file:
+        content = file.read()
+    content = re.sub(r"^\s*//.*$", "", content, flags=re.MULTILINE)
+    content = re.sub(r",(\s*[}\]])", r"\1", content)
+    return json.loads(content)
+
+
+def definition_table():
+    settings = load_settings_file(os.path.join(PACKAGE_DIR, "ansi.sublime-settings"))
+    return ansi_engine.AnsiDefinitionTable(settings["ANSI_FG"], settings["ANSI_BG"])
+
+
+def coverage(regions):
+    """
+    Merge (scope, a, b) regions into the sorted, non-touching regions of every scope.
+    """
+
+    merged = {}
+    for scope, a, b in sorted(regions):
+        spans = merged.setdefault(scope, [])
+        if spans and a <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], b)
+        else:
+            spans.append([a, b])
+    return merged
+
+
+def result_regions(result, begin=0):
+    for scope, region in result.regions.items():
+        for a, b in region:
+            yield scope, a + begin, b + begin
+
+
+def chunks(content, size):
+    for begin in range(0, len(content), size):
+        yield content[begin : begin + size]
+
+
+class AnsiEngineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(PACKAGE_DIR, "test", "ansi_test_file.txt")) as file:
+            cls.content = file.read()
+        cls.table = definition_table()
+        stream = ansi_engine.AnsiStream(cls.table)
+        cls.expected = stream.feed(cls.content, final=True)
+        cls.expected_state = stream.state
+        cls.expected_regions = coverage(result_regions(cls.expected))
+
+    def test_one_shot_parse(self):
+        self.assertNotIn("\x1b", self.expected.text)
+        self.assertGreater(len(self.expected_regions), 1)
+        self.assertEqual(
+            ansi_engine.ansi_strip_text(self.content, self.expected.offsets), self.expected.text
+        )
+
+    def test_stream_chunks(self):
+        for size in CHUNK_SIZES:
+            with self.subTest(chunk_size=size):
+                stream = ansi_engine.AnsiStream(self.table)
+                texts = []
+                regions = []
+                stripped = 0
+                for data in chunks(self.content, size):
+                    result = stream.feed(data)
+                    texts.append(result.text)
+                    regions.extend(result_regions(result, stripped))
+                    stripped += len(result.text)
+                result = stream.flush()
+                texts.append(result.text)
+                regions.extend(result_regions(result, stripped))
+
+                self.assertEqual("".join(texts), self.expected.text)
+                self.assertEqual(coverage(regions), self.expected_regions)
+                self.assertEqual(stream.state, self.expected_state)
+
+    def test_parse_parallel(self):
+        for count in [1, 4, 16]:
+            with self.subTest(count=count), ThreadPoolExecutor(4) as executor:
+                result, state = ansi_engine.ansi_parse_parallel(
+                    self.content, self.table, executor, count
+                )
+
+                self.assertEqual(result.text, self.expected.text)
+                self.assertEqual(coverage(result_regions(result)), self.expected_regions)
+                self.assertEqual(list(result.offsets.spans()), list(self.expected.offsets.spans()))
+                self.assertEqual(state, self.expected_state)
+
+    def test_convert_sidecar(self):
+        for size in CHUNK_SIZES:
+            with self.subTest(chunk_size=size):
+                target = io.StringIO()
+                sidecar = io.BytesIO()
+                ansi_engine.ansi_convert(io.StringIO(self.content), target, sidecar, size)
+                loaded = ansi_engine.ansi_sidecar_loads(sidecar.getvalue())
+                self.assertIsNotNone(loaded)
+                length, _, state, states = loaded
+
+                self.assertEqual(target.getvalue(), self.expected.text)
+                self.assertEqual(length, len(self.expected.text))
+                self.assertEqual(state, self.expected_state)
+                # the states are given the scopes of the settings when the log is opened
+                regions = []
+                for region_state, region in states.items():
+                    scope = self.table.scope(region_state)
+                    if scope is not None:
+                        regions.extend((scope, a, b) for a, b in region)
+                self.assertEqual(coverage(regions), self.expected_regions)
+
+    def test_region_store(self):
+        buckets = [1, 2, 3, ansi_engine.ANSI_REGION_BUCKET_SIZE]
+        for size, bucket_size in [(size, n) for size in CHUNK_SIZES for n in buckets]:
+            with self.subTest(chunk_size=size, bucket_size=bucket_size):
+                store = ansi_engine.AnsiRegionStore(bucket_size)
+                # the regions of every key of the view, as added and erased by the store
+                view = {}
+                stream = ansi_engine.AnsiStream(self.table)
+                stripped = 0
+                for data in list(chunks(self.content, size)) + [None]:
+                    result = stream.feed(data) if data is not None else stream.flush()
+                    for scope, region in result.regions.items():
+                        added, erased = store.append(
+                            scope, [(a + stripped, b + stripped) for a, b in region]
+                        )
+                        for key, regions in added:
+                            view[key] = (scope, list(regions))
+                        for key in erased:
+                            del view[key]
+                    stripped += len(result.text)
+
+                self.assertEqual(set(store.keys()), set(view))
+                regions = []
+                for scope, key_regions in view.values():
+                    regions.extend((scope, a, b) for a, b in key_regions)
+                # what trim() counts is what the view holds
+                self.assertEqual(store.size, len(regions))
+                self.assertEqual(coverage(regions), self.expected_regions)
+
+    def test_region_store_continued_region(self):
+        # the chunks of ansi_test_file.txt never continue a region and fill a bucket at once
+        store = ansi_engine.AnsiRegionStore(3)
+        view = {}
+        for regions in [[(0, 5), (6, 8)], [(8, 10), (12, 14), (16, 18)]]:
+            added, erased = store.append("red", regions)
+            for key, key_regions in added:
+                view[key] = [("red", a, b) for a, b in key_regions]
+            for key in erased:
+                del view[key]
+
+        self.assertEqual(
+            coverage(region for regions in view.values() for region in regions),
+            {"red": [[0, 5], [6, 10], [12, 14], [16, 18]]},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+Check that the ways the plugin colorizes a view agree with a one-shot ansi_parse of its
+text: a whole file, an appended tail, the lazy batches of a large file, the chunks of a
+build (trimmed or not), the sidecar of ansi_convert, the cache of parsed files and a
+reloaded log.
+
+The plugin runs on the sublime stand-in of ansi_benchmark.py, whose timeouts are run until
+none is left, and the regions of a view are compared by the text they color like in
+test_ansi_engine.py.
+
+Usage: python -m unittest discover -s test
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ansi_benchmark  # noqa: E402
+from test_ansi_engine import coverage, result_regions  # noqa: E402
+
+ansi = ansi_benchmark.load_plugin()
+sublime = sys.modules["sublime"]
+ansi_engine = ansi.ansi_engine
+
+
+def view_regions(view):
+    """Get the (scope, a, b) regions added to a view, with the scope they were added with."""
+
+    for key, regions in view._regions.items():
+        for region in regions:
+            if not region.empty():
+                yield view._scopes[key], region.a, region.b
+
+
+def covered(regions):
+    """Get the offsets colored by every scope of (scope, a, b) regions."""
+
+    offsets = {}
+    for scope, a, b in regions:
+        offsets.setdefault(scope, set()).update(range(a, b))
+    return offsets
+
+
+def parse(content):
+    return ansi_engine.AnsiStream(ansi.ansi_definition_table()).feed(content, final=True)
+
+
+class AnsiPluginTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(ansi_benchmark.PACKAGE_DIR, "test", "ansi_test_file.txt")) as file:
+            cls.content = file.read() + ansi_benchmark.generate_log(30000, seed=1)
+        cls.expected = parse(cls.content)
+
+    def setUp(self):
+        self.settings = sublime.load_settings("ansi.sublime-settings")
+        self.saved = dict(self.settings._values)
+        self.segment_size = ansi.ANSI_LAZY_SEGMENT_SIZE
+        self.window = sublime.windows()[0]
+        self.listener = ansi.AnsiEventListener()
+        self.tempdir = tempfile.mkdtemp(prefix="ansi_test_")
+
+    def tearDown(self):
+        ansi_benchmark.run_pending_timeouts(sublime)
+        for view in self.window.views():
+            self.listener.process_view_close(view)
+        del self.window._views[:]
+        self.settings._values = self.saved
+        ansi.ANSI_LAZY_SEGMENT_SIZE = self.segment_size
+        shutil.rmtree(self.tempdir)
+        shutil.rmtree(ansi.ansi_cache_dir(), ignore_errors=True)
+
+    def open_view(self, content, file_name=None):
+        return self.window.open_view(ansi_benchmark.new_output_view(content, file_name))
+
+    def cut(self, begin):
+        # within an escape code, which is left for the next append
+        return self.content.index("\x1b[", begin) + 2
+
+    def build(self, trigger, chunk_size=100):
+        view = ansi_benchmark.new_output_view()
+        build = ansi.AnsiColorBuildCommand()
+        build.output_view = view
+        build.process_trigger = trigger
+        for chunk in ansi_benchmark.split_chunks(self.content, chunk_size):
+            build.on_data(None, chunk)
+        build.on_finished(None)
+        ansi_benchmark.run_pending_timeouts(sublime)
+        return view
+
+    def assertColorized(self, view, expected=None):
+        expected = expected or self.expected
+        ansi_benchmark.run_pending_timeouts(sublime)
+        self.assertEqual(view.text(), expected.text)
+        self.assertEqual(coverage(view_regions(view)), coverage(result_regions(expected)))
+        self.assertFalse(view.settings().get("ansi_in_progress", False))
+        self.assertEqual(view.settings().get("ansi_size"), view.size())
+
+    def test_file(self):
+        view = self.open_view(self.content)
+        view.run_command("ansi")
+        self.assertColorized(view)
+
+    def test_appended(self):
+        cut = self.cut(len(self.content) // 2)
+        view = self.open_view(self.content[:cut])
+        view.run_command("ansi")
+        ansi_benchmark.run_pending_timeouts(sublime)
+        self.assertLess(view.settings().get("ansi_size"), view.size())
+
+        view.append(self.content[cut:])
+        view.run_command("ansi", {"begin": view.settings().get("ansi_size")})
+        self.assertColorized(view)
+
+    def test_lazy(self):
+        self.settings.set("ANSI_lazy_size", 1000)
+        ansi.ANSI_LAZY_SEGMENT_SIZE = 2000
+        cut = self.cut(len(self.content) // 2)
+        view = self.open_view(self.content[:cut])
+        view.run_command("ansi")
+        self.assertIn(view.id(), ansi.ansi_lazy_jobs)
+
+        # appended while the batches are being colorized
+        view.append(self.content[cut:])
+        self.listener.on_modified_async(view)
+        self.assertColorized(view)
+
+    def test_build(self):
+        for trigger in ["on_data", "on_batch", "on_finish"]:
+            with self.subTest(trigger=trigger):
+                view = self.build(trigger)
+                self.assertEqual(view.text(), self.expected.text)
+                self.assertEqual(
+                    coverage(view_regions(view)), coverage(result_regions(self.expected))
+                )
+
+    def test_build_trimmed(self):
+        limit = 500
+        self.settings.set("ANSI_max_regions", limit)
+        expected = covered(result_regions(self.expected))
+        for trigger in ["on_data", "on_batch"]:
+            with self.subTest(trigger=trigger):
+                view = self.build(trigger)
+                self.assertEqual(view.text(), self.expected.text)
+                self.assertLessEqual(view.region_count(), limit)
+                # the regions left are the ones of the output, only fewer
+                for scope, offsets in covered(view_regions(view)).items():
+                    self.assertLessEqual(offsets, expected[scope])
+
+    def test_sidecar(self):
+        source = os.path.join(self.tempdir, "build.log")
+        target = os.path.join(self.tempdir, "build.clean.log")
+        with open(source, "w", newline="") as file:
+            file.write(self.content)
+        with open(source, newline="") as source_file, open(
+            target, "w", newline=""
+        ) as target_file, open(target + ansi_engine.ANSI_SIDECAR_SUFFIX, "wb") as sidecar:
+            ansi_engine.ansi_convert(source_file, target_file, sidecar, 1000)
+        with open(target, newline="") as file:
+            view = self.open_view(file.read(), target)
+        view.settings().set("syntax", "Packages/Text/Plain text.sublime-syntax")
+
+        self.listener.process_view_open(view)
+        self.assertColorized(view)
+
+    def test_cache(self):
+        self.settings.set("ANSI_cache_size", 10)
+        file_name = os.path.join(self.tempdir, "build.log")
+        for run in range(2):
+            with self.subTest(run=run):
+                view = self.open_view(self.content, file_name)
+                view.run_command("ansi")
+                self.assertColorized(view)
+                self.assertIsNotNone(ansi.read_ansi_cache(ansi.ansi_cache_key(self.content)))
+
+    def test_reloaded(self):
+        file_name = os.path.join(self.tempdir, "build.log")
+        cut = self.cut(len(self.content) // 3)
+        view = self.open_view(self.content[:cut], file_name)
+        view.run_command("ansi")
+
+        # a growing log, then a log modified before its colorized part
+        grown = self.content.index("\x1b[", 2 * len(self.content) // 3)
+        modified = self.content[:100] + "modified" + self.content[100:]
+        for content in [self.content[:grown], self.content, modified]:
+            with self.subTest(size=len(content)):
+                view.reload(content)
+                self.listener.on_modified_async(view)
+                self.assertColorized(view, parse(content))
+
+
+if __name__ == "__main__":
+    unittest.main()